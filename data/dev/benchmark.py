@@ -0,0 +1,279 @@
+"""Time each phase of the matching process and report the timings as JSON.
+
+The phases are run one at a time, in the order in which Main runs them, on
+synthetic data made by make_synthetic.py or on given data files. Each
+phase is timed separately:
+
+    load                  read and decode the JSON lines
+    tokenize              make Product and Listing objects
+    remove_duplicate_products
+                          make a matcher and deduplicate the products
+    group_listings        set aside listings whose tokens occur earlier
+    index_all_listings    index the listings by token
+    match_indexed_products
+                          find candidates with the index
+    disambiguate_matches  choose the best candidate of each listing and
+                          share it with the listings set aside
+    write_results         write the results file
+    write_viewer_html     write the static HTML viewer
+
+With the automaton engine, compile_automaton and match_by_automaton take
+the place of index_all_listings and match_indexed_products. With the
+vector engine, match_indexed_by_vector takes the place of
+match_indexed_products. Each phase
+is run as many times as requested and the fastest time is reported. A hash
+of the results file is included, so that a speed-up can be checked for
+changes in output.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Peak memory is only reported where available.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repository_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.insert(0, repository_dir)
+
+import make_synthetic
+import matcher
+
+
+class Benchmark:
+    """Runs the phases of the matching process on one data set."""
+
+    def __init__(self, products_path, listings_path, engine, viewer):
+        """Refer to the data files and choose the phases to run."""
+        self.products_path, self.listings_path = products_path, listings_path
+        self.engine = engine
+        self.phases = ['load', 'tokenize', 'remove_duplicate_products',
+                'group_listings']
+        if engine == 'automaton':
+            self.phases += ['compile_automaton', 'match_by_automaton']
+        elif engine == 'vector':
+            self.phases += ['index_all_listings', 'match_indexed_by_vector']
+        else:
+            self.phases += ['index_all_listings', 'match_indexed_products']
+        self.phases += ['disambiguate_matches', 'write_results']
+        if viewer:
+            self.phases.append('write_viewer_html')
+
+    def run(self, out_dir):
+        """Run each phase once. Return a dictionary of phase timings."""
+        # Start with an empty vocabulary and token cache, as a new process
+        #  would.
+        matcher.Parser.set_vocabulary(matcher.Vocabulary())
+        self.out_dir = out_dir
+        timings = {}
+        for phase in self.phases:
+            start_time = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                getattr(self, 'run_' + phase)()
+            timings[phase] = time.perf_counter() - start_time
+        return timings
+
+    def run_load(self):
+        """Read the data files into lists of dictionaries."""
+        self.product_records = self.read_records(self.products_path)
+        self.listing_records = self.read_records(self.listings_path)
+
+    @staticmethod
+    def read_records(path):
+        """Decode JSON lines the way Main.generate_items() does."""
+        records = []
+        with open(path) as in_file:
+            for line_index, line in enumerate(in_file):
+                data = json.loads(line)
+                if 'id' not in data:
+                    data['id'] = line_index + 1
+                records.append(data)
+        return records
+
+    def run_tokenize(self):
+        """Make items, which tokenizes their text fields."""
+        self.products = [matcher.Product(data)
+                for data in self.product_records]
+        self.listings = [matcher.Listing(data)
+                for data in self.listing_records]
+
+    def run_remove_duplicate_products(self):
+        """Make a matcher, which removes duplicate products."""
+        # Matching an empty list of listings leaves a matcher whose phases
+        #  can be run one at a time. The automaton is compiled in a phase of
+        #  its own, so the default engine is used here.
+        self.matcher = matcher.TightMatcher(self.products, [])
+
+    def run_group_listings(self):
+        """Match only the first listing with each sequence of tokens, as
+        Matcher.match_listings() does.
+        """
+        self.matcher.listings, self.duplicates = self.matcher.group_listings(
+                self.listings)
+
+    def run_compile_automaton(self):
+        """Compile the automaton of the product tokens."""
+        self.matcher.compile_automaton()
+
+    def run_match_by_automaton(self):
+        """Find candidates by scanning each title with the automaton."""
+        self.matcher.match_by_automaton()
+
+    def run_match_indexed_by_vector(self):
+        """Find candidates in the indexed listings with NumPy."""
+        self.matcher.match_indexed_by_vector()
+
+    def run_index_all_listings(self):
+        """Index the listings by token and by manufacturer."""
+        self.matcher.index_all_listings()
+
+    def run_match_indexed_products(self):
+        """Find candidates by matching each product with the index."""
+        self.matcher.match_indexed_products()
+
+    def run_disambiguate_matches(self):
+        """Choose the best candidate of each listing."""
+        self.matcher.disambiguate_matches()
+        # The listings set aside share the matches of the first listing.
+        for listing, first in self.duplicates:
+            listing.candidates = first.candidates
+            listing.best_candidate = first.best_candidate
+        self.matcher.listings = self.listings
+
+    def run_write_results(self):
+        """Write the results file to the output directory."""
+        self.results_path = os.path.join(self.out_dir, 'results.txt')
+        with open(self.results_path, 'w') as out_file:
+            self.matcher.write_results(out_file)
+
+    def run_write_viewer_html(self):
+        """Write the static HTML viewer to the output directory."""
+        fragment_dir = os.path.join(repository_dir, 'viewer', 'fragments')
+        header = open(os.path.join(fragment_dir, 'header.html')).read()
+        footer = open(os.path.join(fragment_dir, 'footer.html')).read()
+        html_path = os.path.join(self.out_dir, 'listings.html')
+        with open(html_path, 'w') as out_file:
+            self.matcher.write_viewer_html(out_file, header, footer)
+
+    def describe(self):
+        """Summarize the data and the outcome of the last run."""
+        counts = self.matcher.count_candidates()
+        return {'products': len(self.products),
+                'distinct_products': len(self.matcher.products),
+                'listings': len(self.listings),
+                'candidate_counts': dict((str(count), frequency)
+                        for count, frequency in sorted(counts.items())),
+                'results_sha1': matcher.Snapshot.hash_file(self.results_path)}
+
+
+def peak_memory():
+    """Get the peak resident set size of this process in kilobytes."""
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def describe_version():
+    """Identify the version of the code being benchmarked."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                '--dirty'], cwd=repository_dir, stderr=subprocess.DEVNULL
+                ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Parse command-line options, run the benchmarks, and print JSON."""
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--sizes', default='10000,100000',
+            help='comma-separated numbers of synthetic listings '
+            '(default: 10000,100000)')
+    argparser.add_argument('-p', '--products',
+            help='benchmark a products file instead of synthetic data')
+    argparser.add_argument('-l', '--listings',
+            help='benchmark a listings file instead of synthetic data')
+    argparser.add_argument('--data-dir',
+            help='keep synthetic data in this directory and reuse it')
+    argparser.add_argument('--seed', type=int, default=42)
+    argparser.add_argument('--repeat', type=int, default=1,
+            help='run each benchmark N times and keep the fastest phases')
+    argparser.add_argument('-e', '--engine',
+            choices=['index', 'automaton', 'vector'], default='index')
+    argparser.add_argument('--no-viewer', dest='viewer', action='store_false',
+            help='skip the HTML viewer, which is slow on big data')
+    argparser.add_argument('-o', '--output',
+            help='write the JSON report to a file instead of standard output')
+    argparser.add_argument('--label', help='name of the version benchmarked '
+            '(default: git describe)')
+    arguments = argparser.parse_args()
+    if (arguments.products == None) != (arguments.listings == None):
+        argparser.error('give both a products file and a listings file')
+    if arguments.repeat < 1:
+        argparser.error('the number of repetitions must be positive')
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    data_dir = arguments.data_dir or work_dir
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    if arguments.products:
+        data_sets = [(arguments.products, arguments.listings)]
+    else:
+        data_sets = []
+        for size in map(int, arguments.sizes.split(',')):
+            products_path = os.path.join(data_dir,
+                    'products_%d_%d.txt' % (size, arguments.seed))
+            listings_path = os.path.join(data_dir,
+                    'listings_%d_%d.txt' % (size, arguments.seed))
+            if not (os.path.exists(products_path) and
+                    os.path.exists(listings_path)):
+                print('making %d synthetic listings' % size, file=sys.stderr)
+                make_synthetic.write_data(products_path, listings_path, size,
+                        seed=arguments.seed)
+            data_sets.append((products_path, listings_path))
+    report = {'label': arguments.label or describe_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(), 'engine': arguments.engine,
+            'repeat': arguments.repeat, 'benchmarks': []}
+    try:
+        for products_path, listings_path in data_sets:
+            print('benchmarking %s' % listings_path, file=sys.stderr)
+            benchmark = Benchmark(products_path, listings_path,
+                    arguments.engine, arguments.viewer)
+            best = {}
+            for i in range(arguments.repeat):
+                for phase, seconds in benchmark.run(work_dir).items():
+                    best[phase] = min(seconds, best.get(phase, seconds))
+            result = {'products_path': products_path,
+                    'listings_path': listings_path}
+            result.update(benchmark.describe())
+            result['phases'] = [{'name': phase,
+                    'seconds': round(best[phase], 6)}
+                    for phase in benchmark.phases]
+            result['total_seconds'] = round(sum(best.values()), 6)
+            result['peak_memory_kb'] = peak_memory()
+            report['benchmarks'].append(result)
+            del benchmark
+    finally:
+        shutil.rmtree(work_dir)
+    text = json.dumps(report, indent=2) + '\n'
+    if arguments.output:
+        with open(arguments.output, 'w') as out_file:
+            out_file.write(text)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Make synthetic products and listings for benchmarking at any scale.
+
+The data imitates the challenge data: a few manufacturers account for most
+listings, model names are short runs of letters and digits joined by
+hyphens or spaces, many listings are accessories that mention a camera,
+and many titles occur more than once with different prices.
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import random
+import string
+
+# Manufacturers of the challenge data with their families, model prefixes,
+#  and relative frequencies in the listings.
+known_manufacturers = [
+    ('Canon', ['PowerShot', 'IXUS', 'EOS'], ['SX', 'A', 'SD', 'D', ''], 24),
+    ('Sony', ['Cyber-shot', 'Alpha'], ['DSC-W', 'DSC-T', 'DSLR-A', 'NEX-'],
+            22),
+    ('Olympus', ['Stylus', 'PEN', 'Tough'], ['E-', 'FE-', 'SP-', 'mju '], 18),
+    ('Nikon', ['Coolpix', 'D'], ['S', 'P', 'L', 'D'], 18),
+    ('Panasonic', ['Lumix'], ['DMC-FS', 'DMC-TZ', 'DMC-G', 'DMC-FH'], 13),
+    ('Kodak', ['EasyShare'], ['C', 'M', 'Z', 'DCS'], 12),
+    ('Fujifilm', ['FinePix'], ['S', 'J', 'Z', 'XP', 'F'], 11),
+    ('Samsung', [], ['TL', 'ST', 'PL', 'ES', 'WB'], 10),
+    ('Casio', ['Exilim'], ['EX-Z', 'EX-H', 'QV-', 'EX-FC'], 8),
+    ('Pentax', ['Optio'], ['K-', 'W', 'RZ', 'E'], 8),
+    ('Ricoh', [], ['CX', 'GR', 'R'], 2),
+    ('Leica', [], ['M', 'V-LUX ', 'D-LUX '], 1),
+]
+
+# Words that make up the rest of a listing title.
+camera_phrases = ['Digital Camera', 'Compact Camera', 'Digital SLR Camera',
+        'Kit', 'Body Only', 'Point and Shoot Camera']
+feature_phrases = ['%d.%d MP', '%dx Optical Zoom', '%d.%d-inch LCD',
+        'Wide Angle', 'Image Stabilized', 'HD Video', 'Waterproof',
+        'with %d-%dmm Lens']
+colors = ['Black', 'Silver', 'Red', 'Blue', 'Pink', 'Purple', 'White']
+accessory_phrases = ['Battery for', 'Charger for', 'Case for',
+        'Memory Card for', 'Screen Protector for', 'Lens Cap for',
+        'Replacement Battery compatible with', 'Leather Case - fits']
+accessory_makers = ['DURAGADGET', 'Neewer Electronics Accessories',
+        'Hama', 'Lowepro', 'Kingston', 'SanDisk', 'Energizer', 'Vivitar']
+manufacturer_suffixes = ['', '', '', '', ' Canada', ' Deutschland',
+        ' Electronics', ' UK']
+currencies = ['USD', 'USD', 'USD', 'EUR', 'EUR', 'EUR', 'GBP', 'GBP', 'CAD']
+
+
+class Generator:
+    """Makes products and listings from a seeded random number generator."""
+
+    def __init__(self, product_count, seed):
+        """Make the products, adding synthetic manufacturers as needed."""
+        self.random = random.Random(seed)
+        self.manufacturers = [list(entry) for entry in known_manufacturers]
+        # A long tail of rare manufacturers.
+        while len(self.manufacturers) < 12 + product_count // 40:
+            self.manufacturers.append([self.make_word().capitalize(),
+                    [self.make_word().capitalize()] if self.random.random()
+                    < 0.5 else [], [self.make_prefix()], 0.5])
+        manufacturer_weights = list(itertools.accumulate(
+                entry[3] for entry in self.manufacturers))
+        self.products = []
+        model_names = set()
+        while len(self.products) < product_count:
+            manufacturer, families, prefixes, _ = self.manufacturers[
+                    self.pick(manufacturer_weights)]
+            model = self.make_model(self.random.choice(prefixes))
+            if (manufacturer, model) in model_names:
+                continue
+            model_names.add((manufacturer, model))
+            product = {'manufacturer': manufacturer, 'model': model}
+            if families and self.random.random() < 0.65:
+                product['family'] = self.random.choice(families)
+            product['product_name'] = '_'.join([manufacturer,
+                    product.get('family', ''), model]).replace('__', '_'
+                    ).replace(' ', '_')
+            product['announced-date'] = (
+                    '20%02d-%02d-%02dT19:00:00.000-05:00' % (
+                    self.random.randint(0, 11), self.random.randint(1, 12),
+                    self.random.randint(1, 28)))
+            self.products.append(product)
+        # A few products are popular and most are rarely listed.
+        self.product_weights = list(itertools.accumulate(
+                1.0 / (rank + 1) ** 0.8 for rank in range(len(self.products))))
+
+    def make_word(self):
+        """Make a pronounceable word."""
+        return ''.join(self.random.choice('bcdfgklmnprstvz') +
+                self.random.choice('aeiou')
+                for i in range(self.random.randint(2, 4)))
+
+    def make_prefix(self):
+        """Make a model prefix such as 'DSC-W' or 'TL'."""
+        letters = ''.join(self.random.choice(string.ascii_uppercase)
+                for i in range(self.random.randint(1, 3)))
+        return letters + self.random.choice(['', '', '-'])
+
+    def make_model(self, prefix):
+        """Make a model name such as 'DSC-W310' or 'SX130 IS'."""
+        model = prefix + str(self.random.randint(1, 9999 if prefix else 999))
+        roll = self.random.random()
+        if roll < 0.15:
+            model += ' ' + self.random.choice(['IS', 'HS', 'HD', 'Zoom'])
+        elif roll < 0.25:
+            model += self.random.choice(string.ascii_uppercase)
+        return model
+
+    def vary_model(self, model):
+        """Write a model name the way a seller might."""
+        roll = self.random.random()
+        if roll < 0.1:
+            return model.replace('-', '')
+        if roll < 0.2:
+            return model.replace('-', ' ')
+        if roll < 0.3:
+            return model.replace(' ', '')
+        return model
+
+    def make_features(self):
+        """Make a random list of camera features."""
+        features = []
+        for phrase in self.random.sample(feature_phrases,
+                self.random.randint(0, 4)):
+            count = phrase.count('%d')
+            features.append(phrase % tuple(self.random.randint(1, 20)
+                    for i in range(count)))
+        return features
+
+    def make_listing(self):
+        """Make a listing that refers to a random product, or to nothing."""
+        roll = self.random.random()
+        product = self.products[self.pick(self.product_weights)]
+        manufacturer = product['manufacturer']
+        model = self.vary_model(product['model'])
+        name = [manufacturer]
+        if 'family' in product and self.random.random() < 0.7:
+            name.append(product['family'])
+        name.append(model)
+        if roll < 0.55:
+            # A camera.
+            words = name + self.make_features() + [
+                    self.random.choice(camera_phrases)]
+            if self.random.random() < 0.3:
+                words.append('(%s)' % self.random.choice(colors))
+            listing_manufacturer = (manufacturer +
+                    self.random.choice(manufacturer_suffixes))
+            if self.random.random() < 0.1:
+                listing_manufacturer = listing_manufacturer.upper()
+        elif roll < 0.85:
+            # An accessory that mentions a camera.
+            words = [self.random.choice(accessory_phrases)] + name
+            if self.random.random() < 0.5:
+                other = self.products[self.pick(self.product_weights)]
+                words += ['/', other['manufacturer'], other['model']]
+            listing_manufacturer = self.random.choice(accessory_makers +
+                    [manufacturer])
+        else:
+            # Something else entirely.
+            words = [self.make_word().capitalize() for i in range(
+                    self.random.randint(2, 6))] + self.make_features()
+            listing_manufacturer = self.make_word().capitalize()
+        return {'title': ' '.join(words),
+                'manufacturer': listing_manufacturer,
+                'currency': self.random.choice(currencies),
+                'price': '%.2f' % (self.random.random() ** 2 * 2000 + 5)}
+
+    def pick(self, cumulative_weights):
+        """Pick a random index according to a list of cumulative weights."""
+        target = self.random.random() * cumulative_weights[-1]
+        return bisect.bisect_right(cumulative_weights, target)
+
+    def generate_listings(self, count, duplicate_rate=0.35):
+        """Generate listings, some of which repeat an earlier title."""
+        # Repeated titles are drawn from a bounded pool of recent listings,
+        #  so memory use does not grow with the number of listings.
+        pool = []
+        pool_size = 10000
+        for i in range(count):
+            if pool and self.random.random() < duplicate_rate:
+                listing = dict(self.random.choice(pool))
+                listing['price'] = '%.2f' % (float(listing['price']) *
+                        self.random.uniform(0.9, 1.1))
+            else:
+                listing = self.make_listing()
+                if len(pool) < pool_size:
+                    pool.append(listing)
+                else:
+                    pool[self.random.randrange(pool_size)] = listing
+            yield listing
+
+
+def default_product_count(listing_count):
+    """Scale the number of products with the number of listings, slowly,
+    the way a catalog grows more slowly than the listings that refer to it.
+    """
+    return max(50, int(743 * (listing_count / 20196) ** 0.5))
+
+
+def write_data(products_path, listings_path, listing_count,
+        product_count=None, seed=42):
+    """Write products and listings as JSON lines."""
+    if product_count == None:
+        product_count = default_product_count(listing_count)
+    generator = Generator(product_count, seed)
+    with open(products_path, 'w') as out_file:
+        for product in generator.products:
+            out_file.write(json.dumps(product) + '\n')
+    with open(listings_path, 'w') as out_file:
+        for listing in generator.generate_listings(listing_count):
+            out_file.write(json.dumps(listing, ensure_ascii=False) + '\n')
+
+
+def main():
+    """Parse command-line options and write the data files."""
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('listings', type=int,
+            help='number of listings to make')
+    argparser.add_argument('--products', type=int,
+            help='number of products to make (default: grows with the '
+            'square root of the number of listings)')
+    argparser.add_argument('--seed', type=int, default=42,
+            help='random seed (default: 42)')
+    argparser.add_argument('--products-file', default='synthetic_products.txt')
+    argparser.add_argument('--listings-file', default='synthetic_listings.txt')
+    arguments = argparser.parse_args()
+    write_data(arguments.products_file, arguments.listings_file,
+            arguments.listings, arguments.products, arguments.seed)
+    print(arguments.products_file, arguments.listings_file)
+
+if __name__ == '__main__':
+    main()
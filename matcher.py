@@ -1,15 +1,42 @@
 """A solution to the Sortable coding challenge."""
 
 import argparse
+import array
+import bisect
+import collections
+import functools
+import hashlib
+import heapq
+import http.server
 import inspect
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
 import os.path
+import pickle
 import random
 import re
+import socketserver
+import stat
 import string
+import struct
 import sys
+import tempfile
+import threading
 import time
 
+try:
+    import resource
+except ImportError:
+    resource = None  # Peak memory isn't measured where this is missing.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # The vector engine falls back to the index engine.
+
 
 class Matcher:
     """Implements the general matching process. Supports output generation in
@@ -17,14 +44,330 @@ class Matcher:
     a subclass that defines may_match() and compare_details().
     """
 
-    def __init__(self, products, listings):
-        """Run the matching process."""
+    # Options that can be overridden by keyword arguments to the initializer.
+    engine = 'index'  # The matching engine. See find_candidates().
+    indexes = None  # Prebuilt listing indexes keyed by field. See below.
+    workers = 1  # The number of processes that match listings.
+    shards_per_worker = 4  # Smaller shards even out the load on workers.
+    group_duplicates = True  # Match listings with identical tokens once.
+    candidate_limit = 2  # Listings with more candidates are left unresolved.
+    spill_limit = None  # Sort results on disk if more listings match.
+    spill_dir = None  # Directory for temporary files when sorting on disk.
+    metrics = None  # A Metrics object that instruments this matcher.
+    fuzzy_budget = None  # If set, lookups per listing for inexact matching.
+
+    # The product tokens that a listing field must contain for a product
+    #  to match, besides the manufacturer, which is resolved separately.
+    #  Subclasses can require more of them to shrink the set of listings
+    #  considered by match_product().
+    index_fields = [('title', 'model')]
+    # The cost of a may_match() call relative to a binary search, used in
+    #  deciding whether to intersect posting arrays.
+    check_cost = 15
+
+    def __init__(self, products, listings, **options):
+        """Run the matching process with the given options. Duplicate products
+        are discarded once, up front, so that more listings can be matched
+        with match_chunk().
+        """
+        for name, value in options.items():
+            if not hasattr(Matcher, name):
+                raise TypeError('unknown matcher option: %s' % name)
+            setattr(self, name, value)
+        if self.metrics != None:
+            self.metrics.instrument(self)
         self.products, self.listings = products, listings
+        self.pool = None
         print('matching')
         start_time = time.time()
-        self.match_all_products()
-        self.disambiguate_matches()
-        print('  %.3f s' % (time.time() - start_time))
+        self.remove_duplicate_products()
+        self.compile_products()
+        if self.engine == 'automaton':
+            self.compile_automaton()
+        self.match_listings()
+        seconds = time.time() - start_time
+        print('  %.3f s' % seconds)
+        if self.metrics != None:
+            self.metrics.add_phase('match', seconds)
+
+    def __getstate__(self):
+        """Leave out the metrics when the matcher is copied to a worker
+        process. Metrics are only gathered in the main process.
+        """
+        state = self.__dict__.copy()
+        if self.metrics != None:
+            for name in self.metrics.wrapped_methods:
+                state.pop(name, None)
+            state['metrics'] = None
+        state['pool'] = None
+        return state
+
+    def match_chunk(self, listings):
+        """Replace the current listings with a new chunk and match it."""
+        # The index and the candidate lists of the previous chunk are
+        #  discarded, so memory use is bounded by the size of one chunk.
+        self.listings = listings
+        self.match_listings()
+
+    def refine(self, matcher_class, **options):
+        """Match the current listings with stricter rules, which accept a
+        subset of the candidates that this matcher's rules accept. Only
+        these candidates are checked, so the listings need no index. Return
+        the new matcher. The products are shared, so their rules are
+        compiled again for it, and this matcher must not match any more.
+        Options that aren't given are copied from this matcher, apart from
+        those that only affect finding candidates in the listings.
+        """
+        for name in ['candidate_limit', 'spill_limit', 'spill_dir',
+                'metrics', 'fuzzy_budget']:
+            options.setdefault(name, getattr(self, name))
+        matcher = matcher_class(self.products, [], **options)
+        matcher.listings = self.listings
+        may_match = matcher.may_match
+        for listing in self.listings:
+            if listing.candidates:
+                listing.candidates = [product for product in
+                        listing.candidates if may_match(listing, product)]
+            listing.best_candidate = None
+        # Inexact candidates never pass may_match(), so listings are given
+        #  the inexact candidates of the stricter rules instead.
+        if matcher.fuzzy_budget != None:
+            matcher.match_fuzzy()
+            matcher.count_fuzzy(self.listings)
+        matcher.disambiguate_matches()
+        return matcher
+
+    def match_listings(self):
+        """Find the candidates and the best candidate of each listing."""
+        # Many listings differ only in price or currency. Matching depends
+        #  on nothing but tokens, so the first listing with a given sequence
+        #  of manufacturer and title tokens is matched on behalf of the rest.
+        listings = self.listings
+        duplicates = []
+        if self.group_duplicates and not self.has_prebuilt_index():
+            self.listings, duplicates = self.group_listings(listings)
+        if self.workers > 1 and len(self.listings) > 1:
+            self.match_in_parallel()
+        else:
+            self.find_candidates()
+            self.disambiguate_matches()
+        distinct, self.listings = self.listings, listings
+        # The candidate lists are shared rather than copied.
+        for listing, first in duplicates:
+            listing.candidates = first.candidates
+            listing.best_candidate = first.best_candidate
+        if self.fuzzy_budget != None:
+            self.count_fuzzy(distinct, duplicates)
+
+    def has_prebuilt_index(self):
+        """Check whether a prebuilt title index, such as one loaded from a
+        snapshot, was made for the current listings and will be used by the
+        engine. Its positions are those of all the listings, so they aren't
+        grouped: reading the index is cheaper than grouping and indexing.
+        """
+        index = self.indexes.get('title') if self.indexes else None
+        return (index != None and index.listings is self.listings and
+                self.engine != 'automaton' and self.workers == 1)
+
+    @staticmethod
+    def group_listings(listings):
+        """Find the first listing with each sequence of manufacturer and
+        title tokens. Return a list of these listings and a list of pairs,
+        each made of a later listing and the first one with its tokens.
+        """
+        firsts = {}
+        distinct, duplicates = [], []
+        for listing in listings:
+            key = (listing.tokens.manufacturer.ids.tobytes(),
+                    listing.tokens.title.ids.tobytes())
+            first = firsts.get(key)
+            if first == None:
+                firsts[key] = listing
+                distinct.append(listing)
+            else:
+                duplicates.append((listing, first))
+        return distinct, duplicates
+
+    def find_candidates(self):
+        """Use the selected engine to find each listing's match candidates."""
+        # The index engine probes a listing index once per product. The
+        #  automaton engine scans each listing title once for the tokens of
+        #  all products. The vector engine probes the index like the index
+        #  engine, then checks all of a product's listings at once with NumPy.
+        #  All yield the same candidates in the same order.
+        if self.engine == 'automaton':
+            self.match_by_automaton()
+        elif self.engine == 'vector' and numpy != None:
+            self.match_by_vector()
+        else:
+            self.match_all_products()
+        if self.fuzzy_budget != None:
+            self.match_fuzzy()
+
+    def match_fuzzy(self):
+        """Give listings that have no candidates another chance, looking for
+        model tokens that are joined or split differently in the title, or
+        that are one edit away. See FuzzyModelIndex. A listing that needs
+        more than fuzzy_budget lookups is left without candidates. The
+        outcome for each listing is kept until count_fuzzy() is called.
+        """
+        outcomes = self.fuzzy_outcomes
+        for listing in self.listings:
+            if not listing.candidates:
+                outcome = self.match_listing_fuzzy(listing)
+                if outcome != None:
+                    outcomes[id(listing)] = outcome
+
+    def match_listing_fuzzy(self, listing):
+        """Look for the inexact candidates of a listing. Return 'matched' or
+        'over_budget', or None if there are no candidates.
+        """
+        index = self.fuzzy_index
+        spans = index.find(index.texts(listing.tokens.title),
+                self.fuzzy_budget)
+        if spans == None:
+            return 'over_budget'
+        found = []
+        for start, end, key in spans:
+            for product in index.products[key]:
+                if product not in found and self.may_match_span(
+                        listing, product, start, end):
+                    found.append(product)
+        if found:
+            listing.candidates = found
+            return 'matched'
+        return None
+
+    def count_fuzzy(self, listings, duplicates=()):
+        """Add the outcomes of match_fuzzy() to fuzzy_counts, once for each
+        listing, counting each of a list of (listing, first) pairs as its
+        first listing. The outcomes are then discarded.
+        """
+        outcomes = self.fuzzy_outcomes
+        for listing, first in itertools.chain(
+                [(listing, listing) for listing in listings], duplicates):
+            outcome = outcomes.get(id(first))
+            if outcome != None:
+                self.fuzzy_counts[outcome] += 1
+        outcomes.clear()
+
+    @staticmethod
+    def joined_text(token_list, start, end):
+        """Join the text of a range of tokens, or return None if the range
+        is out of bounds or includes a token that isn't in the vocabulary.
+        """
+        if start < 0 or end > len(token_list):
+            return None
+        ids = token_list.ids[start:end]
+        if -1 in ids:
+            return None
+        strings = Parser.vocabulary.strings
+        return ''.join(strings[token_id] for token_id in ids)
+
+    def match_in_parallel(self):
+        """Split the listings into shards and match each shard in a worker
+        process that builds its own index and disambiguates its own matches.
+        The parent process gathers the results in the original order, so the
+        outcome is identical to that of serial matching.
+        """
+        listings = self.listings
+        shard_count = min(self.workers * self.shards_per_worker, len(listings))
+        bounds = [(i * len(listings) // shard_count,
+                (i + 1) * len(listings) // shard_count)
+                for i in range(shard_count)]
+        if self.pool != None:
+            # The workers started before these listings were read, so the
+            #  listings are sent with the shards, and so are the strings
+            #  added to the vocabulary since.
+            strings = Parser.vocabulary.strings[self.pool_vocabulary_size:]
+            shard_results = self.pool.imap(Matcher.match_shard,
+                    [(start, end, listings[start:end], strings)
+                    for start, end in bounds])
+            self.gather_results(bounds, shard_results)
+            return
+        pool = self.start_pool()
+        try:
+            self.gather_results(bounds, pool.imap(Matcher.match_shard,
+                    [(start, end, None, None) for start, end in bounds]))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def start_pool(self):
+        """Start worker processes that each get a copy of this matcher. On
+        platforms that fork, the copy is made without pickling.
+        """
+        self.pool_vocabulary_size = len(Parser.vocabulary)
+        return multiprocessing.Pool(self.workers, Matcher.start_worker,
+                (self, Parser.vocabulary))
+
+    def open_pool(self):
+        """Keep worker processes for matching chunk after chunk, rather
+        than start new ones for each chunk, until close_pool() is called.
+        """
+        self.pool = self.start_pool()
+
+    def close_pool(self):
+        """Stop the worker processes started by open_pool()."""
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def gather_results(self, bounds, shard_results):
+        """Set the candidates and best candidates of the listings from the
+        results of match_shard() for each range of listings.
+        """
+        listings = self.listings
+        for (start, end), results in zip(bounds, shard_results):
+            for listing, (positions, best_position, fuzzy_outcome) in zip(
+                    listings[start:end], results):
+                listing.candidates = [self.products[position]
+                        for position in positions]
+                listing.best_candidate = (None if best_position == -1
+                        else self.products[best_position])
+                if fuzzy_outcome != None:
+                    self.fuzzy_outcomes[id(listing)] = fuzzy_outcome
+
+    @staticmethod
+    def start_worker(matcher, vocabulary):
+        """Keep the matcher and its full list of listings in a worker."""
+        Parser.set_vocabulary(vocabulary)
+        Matcher.worker_matcher = matcher
+        Matcher.worker_listings = matcher.listings
+
+    @staticmethod
+    def match_shard(task):
+        """Match a range of listings in a worker process. Unless the
+        listings and the strings added to the vocabulary since the worker
+        started are given, they are taken from the worker's copy. Products
+        are identified by their positions in the matcher's product list,
+        and each listing's result includes the outcome of match_fuzzy().
+        """
+        matcher = Matcher.worker_matcher
+        start, end, listings, strings = task
+        if listings == None:
+            listings = Matcher.worker_listings[start:end]
+        else:
+            Parser.truncate_vocabulary(matcher.pool_vocabulary_size)
+            for text in strings:
+                Parser.vocabulary.intern(text)
+        matcher.listings = listings
+        matcher.find_candidates()
+        matcher.disambiguate_matches()
+        positions = dict((id(product), position)
+                for position, product in enumerate(matcher.products))
+        outcomes = (matcher.fuzzy_outcomes if matcher.fuzzy_budget != None
+                else {})
+        results = []
+        for listing in matcher.listings:
+            best = listing.best_candidate
+            results.append(([positions[id(product)] for product in
+                    listing.candidates],
+                    -1 if best == None else positions[id(best)],
+                    outcomes.pop(id(listing), None)))
+        return results
 
     def match_all_products(self):
         """Iterate over products first to match them with listings."""
@@ -36,8 +379,13 @@ class Matcher:
         #  the listing tokens act as a document to which we apply the query.
         #  Thus, it is the listings -- the documents, as it were -- that must
         #  be indexed.
-        self.remove_duplicate_products()
         self.index_all_listings()
+        self.match_indexed_products()
+
+    def match_indexed_products(self):
+        """Match each product with the listings, which must have been
+        indexed by index_all_listings().
+        """
         for listing in self.listings:
             listing.candidates = []
             listing.best_candidate = None
@@ -67,41 +415,207 @@ class Matcher:
             products.append(product)
         self.products = products
 
+    def compile_products(self):
+        """Give each product a rule object that holds what the match rules
+        check, so that checks don't look up the same fields again and again.
+        Group the products by manufacturer tokens for a ManufacturerResolver,
+        which is kept for as long as the matcher, so that its cache serves
+        every chunk or request that the matcher handles.
+        """
+        self.manufacturers = ManufacturerResolver()
+        for product in self.products:
+            rule = product.rule = self.compile_rule(product)
+            rule.manufacturer_group = self.manufacturers.add(
+                    rule.manufacturer)
+        if self.fuzzy_budget != None:
+            self.fuzzy_index = FuzzyModelIndex(self.products)
+            self.fuzzy_counts = {'matched': 0, 'over_budget': 0}
+            # Maps the ID of each listing to its outcome until it's counted.
+            self.fuzzy_outcomes = {}
+
+    def compile_rule(self, product):
+        """Make the rule object of a product. Subclasses whose rules check
+        more than the tokens and lengths in a ProductRule can extend it.
+        """
+        return ProductRule(product)
+
     def index_all_listings(self):
-        """Index the listings using their manufacturer and title tokens."""
-        for field in ['manufacturer', 'title']:
+        """Index the listings using their title tokens, and group them by the
+        product manufacturers that their manufacturers satisfy.
+        """
+        # Map each manufacturer group to a sorted array of the positions of
+        #  the listings in the group. A listing's manufacturer is resolved by
+        #  a dictionary lookup, except the first time that it occurs.
+        index = {}
+        resolve = self.manufacturers.resolve
+        for position, listing in enumerate(self.listings):
+            for group in resolve(listing.tokens.manufacturer):
+                postings = index.get(group)
+                if postings == None:
+                    index[group] = array.array('i', [position])
+                else:
+                    postings.append(position)
+        self.manufacturer_group_index = index
+        # Use a prebuilt title index, such as one loaded from a snapshot, if
+        #  it was made for the current listings.
+        if self.has_prebuilt_index():
+            index = self.indexes['title']
+        else:
+            # Map each token ID to a sorted array of the positions of the
+            #  listings that contain the token.
             index = {}
-            for listing in self.listings:
-                for token in getattr(listing.tokens, field):
-                    index.setdefault(token.text, set()).add(listing)
-            setattr(self, field + '_index', index)
+            for position, listing in enumerate(self.listings):
+                for token_id in listing.tokens.title.ids:
+                    postings = index.get(token_id)
+                    if postings == None:
+                        index[token_id] = array.array('i', [position])
+                    elif postings[-1] != position:
+                        postings.append(position)
+        self.title_index = index
 
     def match_product(self, product):
         """Consider the given product as a match candidate for each listing."""
         listings = self.listings
-        # Use token indices to get a smaller set of listings.
-        for listing_field, product_field in [
-                ('manufacturer', 'manufacturer'),
-                ('title', 'model')]:
+        positions = self.candidate_positions(product)
+        if positions != None:
+            listings = [listings[position] for position in positions]
+        may_match = self.may_match
+        for listing in listings:
+            if may_match(listing, product):
+                listing.candidates.append(product)
+
+    def candidate_positions(self, product):
+        """Find the positions of the listings that may match a product.
+        Return None if all listings must be considered.
+        """
+        # Gather the posting arrays of the product's manufacturer group and of
+        #  the tokens that a matching listing must contain. If the group or a
+        #  token has no listings, nothing matches.
+        try:
+            group_index = self.manufacturer_group_index
+        except AttributeError:
+            # If the listings weren't indexed, we consider all of them.
+            return None
+        postings = [group_index.get(product.rule.manufacturer_group)]
+        if postings[0] == None:
+            return []
+        for listing_field, product_field in self.index_fields:
             try:
                 index = getattr(self, listing_field + '_index')
             except AttributeError:
                 # If the listings weren't indexed, the _index attribute
-                #  doesn't exist and we bail out on the first iteration.
+                #  doesn't exist and we consider all listings.
+                return None
+            tokens = getattr(product.tokens, product_field, None)
+            if tokens == None:
+                continue
+            for token_id in tokens.ids:
+                positions = index.get(token_id)
+                if positions == None:
+                    return []
+                postings.append(positions)
+        if not postings:
+            return None
+        return self.plan_intersection(postings)
+
+    def plan_intersection(self, postings):
+        """Intersect posting arrays for as long as it pays. Return a sorted
+        sequence of listing positions that includes all of the listings in
+        the intersection of the arrays.
+        """
+        # Start with the smallest array. Intersecting it with the next one
+        #  costs a binary search per position, whereas each position that the
+        #  intersection removes saves a may_match() call. Assuming that tokens
+        #  occur independently, we can estimate how many positions remain.
+        #  Larger arrays remove fewer positions at a higher cost, so once an
+        #  intersection doesn't pay, the following ones won't either.
+        postings = sorted(postings, key=len)
+        result = postings[0]
+        listing_count = len(self.listings)
+        for positions in postings[1:]:
+            if len(result) == 0:
+                break
+            remaining = len(result) * len(positions) / listing_count
+            if len(result) >= (len(result) - remaining) * self.check_cost:
+                break
+            result = self.intersect(result, positions)
+        return result
+
+    @staticmethod
+    def intersect(small, large):
+        """Intersect two sorted sequences of integers. Return an array."""
+        # Each binary search starts where the previous one left off.
+        result = array.array('i')
+        low, size = 0, len(large)
+        for value in small:
+            low = bisect.bisect_left(large, value, low)
+            if low == size:
                 break
-            tokens = getattr(product.tokens, product_field)
-            # For each product token, find the set of listings that include the
-            #  token. Use the smallest such set. (Set intersection would yield
-            #  a smaller set but increase the overall computational cost.)
-            for token in tokens:
-                if token.text not in index:
-                    return
-                try_listings = index[token.text]
-                if len(try_listings) < len(listings):
-                    listings = try_listings
+            if large[low] == value:
+                result.append(value)
+        return result
+
+    def match_by_vector(self):
+        """Iterate over products first, as the index engine does, but check
+        all the listings chosen for a product at once, using NumPy.
+        """
+        self.index_all_listings()
+        self.match_indexed_by_vector()
+
+    def match_indexed_by_vector(self):
+        """Do the work of match_by_vector() on listings that have been
+        indexed by index_all_listings().
+        """
+        self.encode_listings()
+        listings = self.listings
         for listing in listings:
-            if self.may_match(listing, product):
-                listing.candidates.append(product)
+            listing.candidates = []
+            listing.best_candidate = None
+        for product in self.products:
+            positions = self.candidate_positions(product)
+            if positions == None:
+                positions = numpy.arange(len(listings))
+            elif len(positions) == 0:
+                continue
+            else:
+                positions = numpy.asarray(positions)
+            for position in positions[self.may_match_batch(positions,
+                    product)].tolist():
+                listings[position].candidates.append(product)
+
+    def encode_listings(self):
+        """Make a matrix of token IDs for each listing field, with a row per
+        listing. Rows are padded with -1, which is never a token ID.
+        """
+        for field in Snapshot.fields:
+            lengths = numpy.fromiter((len(getattr(listing.tokens, field))
+                    for listing in self.listings), numpy.intp,
+                    len(self.listings))
+            # There is at least one column, so that an empty sublist is found
+            #  in every row, as find() finds it in every token list.
+            width = int(lengths.max(initial=1))
+            matrix = numpy.full((len(lengths), width), -1, numpy.int32)
+            ids = array.array('i')
+            for listing in self.listings:
+                ids.extend(getattr(listing.tokens, field).ids)
+            # Fill each row from the left with the listing's tokens.
+            matrix[numpy.arange(width) < lengths[:, None]] = numpy.frombuffer(
+                    ids, numpy.int32)
+            setattr(self, field + '_matrix', matrix)
+
+    @staticmethod
+    def find_batch(matrix, sublist):
+        """Search each row of a token matrix for a sublist. Return a boolean
+        matrix of the same shape that is true where the sublist starts.
+        """
+        rows, width = matrix.shape
+        found = numpy.ones((rows, width), bool)
+        found[:, max(0, width - len(sublist.ids) + 1):] = False
+        for i, token_id in enumerate(sublist.ids):
+            if i >= width:
+                break
+            found[:, :width - i] &= matrix[:, i:] == token_id
+        return found
 
     def match_all_listings(self):
         """Iterate over listings first and match them with products."""
@@ -119,49 +633,119 @@ class Matcher:
             if self.may_match(listing, product):
                 listing.candidates.append(product)
 
+    def compile_automaton(self):
+        """Compile the model and family tokens of all products into a single
+        automaton that finds them in a listing title in one pass.
+        """
+        sequences, sequence_indices = [], {}
+        def add(tokens):
+            key = tuple(tokens.ids)
+            if key not in sequence_indices:
+                sequence_indices[key] = len(sequences)
+                sequences.append(key)
+            return sequence_indices[key]
+        # Map each model sequence to the positions of the products that have
+        #  it. For each product, note its model and family sequences.
+        self.model_products = {}
+        self.product_sequences = []
+        for position, product in enumerate(self.products):
+            model_index = add(product.tokens.model)
+            family_index = (add(product.tokens.family)
+                    if hasattr(product.tokens, 'family') else None)
+            self.model_products.setdefault(model_index, []).append(position)
+            self.product_sequences.append((model_index, family_index))
+        self.automaton = TokenAutomaton(sequences)
+
+    def match_by_automaton(self):
+        """Iterate over listings first, scanning each title only once."""
+        for listing in self.listings:
+            self.match_listing_by_automaton(listing)
+
+    def match_listing_by_automaton(self, listing):
+        """Find the candidates of one listing with the automaton. Only the
+        listing is modified, so this can be done in several threads at once.
+        """
+        # We assume, as the index engine does, that a product can only match
+        #  a listing whose title contains the product's model tokens.
+        products = self.products
+        product_sequences = self.product_sequences
+        listing.candidates = []
+        listing.best_candidate = None
+        found = self.automaton.find_all(listing.tokens.title.ids)
+        positions = []
+        for sequence_index in found:
+            positions.extend(self.model_products.get(sequence_index, []))
+        # Candidates are listed in product order, as with the index engine.
+        positions.sort()
+        for position in positions:
+            model_index, family_index = product_sequences[position]
+            family_starts = (None if family_index == None else
+                    found.get(family_index, []))
+            if self.may_match_found(listing, products[position],
+                    found[model_index], family_starts):
+                listing.candidates.append(products[position])
+
+    def may_match_found(self, listing, product, model_starts, family_starts):
+        """Decide whether a listing is potentially matched by a product, given
+        the start positions of the product's model tokens in the listing title
+        and likewise for the family tokens, or None if there is no family.
+        By default, the positions are ignored and may_match() decides.
+        """
+        return self.may_match(listing, product)
+
     @staticmethod
     def find(tokens, sublist):
         """Search a token list for a sublist. Return the start index or -1."""
-        for start in range(0, len(tokens) - len(sublist) + 1):
-            okay = True
-            for i, word in enumerate(sublist):
-                if tokens[start + i].text != word.text:
-                    okay = False
-                    break
-            if okay:
-                return start
+        # Compare token IDs rather than making Token objects. The rest of
+        #  the sublist is only compared where its first token is found.
+        ids, sublist_ids = tokens.ids, sublist.ids
+        length = len(sublist_ids)
+        if length == 0:
+            return 0
+        first = sublist_ids[0]
+        for start in range(0, len(ids) - length + 1):
+            if ids[start] == first:
+                for i in range(1, length):
+                    if ids[start + i] != sublist_ids[i]:
+                        break
+                else:
+                    return start
         return -1
 
     @staticmethod
     def find_all(tokens, sublist):
         """Search for a sublist of tokens. Return a list of start indices."""
-        result = []
-        for start in range(0, len(tokens) - len(sublist) + 1):
-            okay = True
-            for i, word in enumerate(sublist):
-                if tokens[start + i].text != word.text:
-                    okay = False
-                    break
-            if okay:
-                result.append(start)
-        return result
+        ids, sublist_ids = tokens.ids, sublist.ids
+        length = len(sublist_ids)
+        if length == 0:
+            return list(range(0, len(ids) + 1))
+        first = sublist_ids[0]
+        result = [start for start in range(0, len(ids) - length + 1)
+                if ids[start] == first]
+        if length == 1:
+            return result
+        return [start for start in result if all(ids[start + i] ==
+                sublist_ids[i] for i in range(1, length))]
 
     def disambiguate_matches(self):
         """Try to resolve cases of listings with several match candidates."""
         for listing in self.listings:
-            candidates = listing.candidates
-            # If there are many candidates, assume that the listing does not
-            #  describe any particular product.
-            if len(candidates) == 0 or len(candidates) > 2:
-                continue
-            if len(candidates) == 1:
-                listing.best_candidate = candidates[0]
-                continue
-            self.detail_sort(listing, candidates)
-            if self.compare_details(listing,
-                    candidates[0], candidates[1]) == 0:
-                continue
+            self.disambiguate(listing)
+
+    def disambiguate(self, listing):
+        """Choose the best candidate of one listing, if possible."""
+        candidates = listing.candidates
+        # If there are many candidates, assume that the listing does not
+        #  describe any particular product.
+        if len(candidates) == 0 or len(candidates) > self.candidate_limit:
+            return
+        if len(candidates) == 1:
             listing.best_candidate = candidates[0]
+            return
+        self.detail_sort(listing, candidates)
+        if self.compare_details(listing, candidates[0], candidates[1]) == 0:
+            return
+        listing.best_candidate = candidates[0]
 
     def detail_sort(self, listing, products, start=0, length=None):
         """Sort products in place, using compare_details() on product pairs."""
@@ -185,158 +769,377 @@ class Matcher:
         self.detail_sort(listing, products, start, left - start)
         self.detail_sort(listing, products, left + 1, right - left)
 
-    def print_candidate_counts(self):
-        """Count each listing's candidates and show the count frequencies."""
-        counts = {}
+    def count_candidates(self, counts=None):
+        """Count each listing's candidates and tally the count frequencies.
+        If a dictionary of frequencies is given, add to it and return it.
+        """
+        if counts == None:
+            counts = {}
         for listing in self.listings:
-            count = len(listing.candidates)
-            # If a multiple-candidate case was successfully resolved, count
-            #  it as a single-candidate case.
-            if listing.best_candidate != None:
-                count = 1
+            count = self.candidate_count(listing)
             counts[count] = counts.setdefault(count, 0) + 1
+        return counts
+
+    @staticmethod
+    def candidate_count(listing):
+        """Get the number of candidates that a listing is tallied under."""
+        # If a multiple-candidate case was successfully resolved, count it
+        #  as a single-candidate case.
+        if listing.best_candidate != None:
+            return 1
+        return len(listing.candidates)
+
+    @staticmethod
+    def print_candidate_tables(named_counts):
+        """Show tallies made by count_candidates() for several rule sets side
+        by side, given a list of pairs of a name and a tally.
+        """
+        print('candidate-count frequencies:')
+        print('    ' + ''.join('%16s' % name for name, counts in named_counts))
+        totals = [sum(counts.values()) for name, counts in named_counts]
+        for count in sorted(set().union(*[counts
+                for name, counts in named_counts])):
+            print('%3d:' % count + ''.join('%9d %5.1f%%' % (
+                    counts.get(count, 0), 100.0 * counts.get(count, 0) /
+                    total) for (name, counts), total in zip(named_counts,
+                    totals)))
+
+    def print_candidate_counts(self, counts=None):
+        """Show the candidate-count frequencies of the current listings, or
+        a tally previously made by count_candidates().
+        """
+        if counts == None:
+            counts = self.count_candidates()
+        total = sum(counts.values())
         print('candidate-count frequencies:')
         for count, frequency in sorted(counts.items()):
-            proportion = 100.0 * frequency / len(self.listings)
+            proportion = 100.0 * frequency / total
             print('%3d: %d %.1f%%' % (count, frequency, proportion))
 
     def write_results(self, out_file):
-        """Write out final matches in the required challenge format."""
-        result_map = {}
+        """Write out final matches in the required challenge format. Each
+        line is written as soon as it is made, so the output as a whole is
+        never held in memory. Beyond spill_limit matched listings, the
+        results are sorted on disk instead.
+        """
+        if self.spill_limit != None and sum(listing.best_candidate != None
+                for listing in self.listings) > self.spill_limit:
+            spill = ResultSpill(self.spill_dir)
+            try:
+                for start in range(0, len(self.listings), self.spill_limit):
+                    spill.add(self.listings[start:start + self.spill_limit])
+                spill.write(out_file)
+            finally:
+                spill.close()
+            return
+        wrote_group = False
+        for product_name, line in self.generate_result_lines():
+            out_file.write(line)
+            wrote_group = True
+        # An empty file of results still has a newline.
+        if not wrote_group:
+            out_file.write('\n')
+
+    def generate_result_lines(self, product_names=None):
+        """Generate pairs of a product name and its line of results, in
+        order of product name. Optionally, generate only the lines of the
+        products named in a set.
+        """
+        # Group references to the listings, and encode one group at a time.
+        groups = {}
         for listing in self.listings:
             product = listing.best_candidate
-            if product == None:
+            if product == None or (product_names != None and
+                    product.product_name not in product_names):
                 continue
-            result_map.setdefault(product.product_name, []).append(listing)
-        out_file.write('\n'.join(json.dumps(
-                {'product_name': product_name,
-                 'listings': [listing.result_data for listing in listings]},
-                ensure_ascii=False) for product_name, listings in
-                sorted(result_map.items())) + '\n')
-
-    def write_data_js(self, out_file):
-        """Convert products and listings into dictionaries. Write them to a
-        JavaScript file that can be used to dynamically build a web page
-        that displays listings with candidates.
-        """
-        product_items = len(self.products) * [None]
-        for i, product in enumerate(self.products):
-            item = product_items[i] = {'id': product.id}
+            groups.setdefault(product.product_name, []).append(listing)
+        for product_name in sorted(groups):
+            yield product_name, ResultSpill.format_group(
+                    json.dumps(product_name, ensure_ascii=False),
+                    [json.dumps(listing.result_data, ensure_ascii=False)
+                    for listing in groups.pop(product_name)])
+
+    def write_data_js(self, data_dir, chunk_size):
+        """Write JavaScript files that can be used to dynamically build a web
+        page that displays listings with candidates. An index file holds the
+        products and the size of each viewer group. The listings of each
+        group are written to chunk files of chunk_size listings, which the
+        page loads as they are needed.
+        """
+        # Remove the files of a previous run.
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        for name in os.listdir(data_dir):
+            if re.match('^(index|[a-z]+-[0-9]+)[.]js$', name):
+                os.remove(os.path.join(data_dir, name))
+        # Products are referred to by their positions in the index. Text
+        #  fields are followed by flat arrays of token start and end indices.
+        positions = {}
+        product_items = []
+        for position, product in enumerate(self.products):
+            positions[id(product)] = position
+            item = [product.id]
             for field in ['manufacturer', 'family', 'model']:
                 # A product may not have the family attribute.
                 if not hasattr(product, field):
+                    item.extend([None, None])
                     continue
-                # Make a dictionary containing text and tokens.
-                item[field] = {'text': getattr(product, field),
-                        'tokenSpans': [token.span for token in
-                                getattr(product.tokens, field)]}
-        out_file.write('var products = %s;\n' % (json.dumps(product_items,
-                ensure_ascii=False)))
-        listing_items = len(self.listings) * [None]
-        for i, listing in enumerate(self.listings):
-            item = listing_items[i] = {'id': listing.id}
+                item.extend([getattr(product, field),
+                        self.flat_token_spans(getattr(product.tokens, field))])
+            product_items.append(item)
+        # The viewer makes its own headers from the counts.
+        counts = self.count_viewer_groups()[0]
+        groups = [{'name': name, 'count': count,
+                'chunkCount': (count + chunk_size - 1) // chunk_size}
+                for (name, header_text, plural), count in zip(
+                self.viewer_groups, counts)]
+        with open(os.path.join(data_dir, 'index.js'), 'w') as out_file:
+            out_file.write('ListingViewer.setIndex(%s);\n' % json.dumps(
+                    {'chunkSize': chunk_size,
+                     'listingCount': len(self.listings),
+                     'groups': groups, 'products': product_items},
+                    ensure_ascii=False))
+        # Fill a chunk for each group in a single pass over the listings.
+        chunks = [[] for group in groups]
+        chunk_counts = [0] * len(groups)
+        def write_chunk(group_index):
+            chunk_counts[group_index] += 1
+            name = groups[group_index]['name']
+            path = os.path.join(data_dir, '%s-%d.js' % (name,
+                    chunk_counts[group_index]))
+            with open(path, 'w') as out_file:
+                out_file.write('ListingViewer.addChunk(%s, %d, %s);\n' % (
+                        json.dumps(name), chunk_counts[group_index],
+                        json.dumps(chunks[group_index], ensure_ascii=False)))
+            chunks[group_index] = []
+        for listing in sorted(self.listings, key=lambda x: x.id):
+            item = [listing.id]
             for field in ['manufacturer', 'title']:
-                # Make a dictionary containing text and tokens.
-                item[field] = {'text': getattr(listing, field),
-                        'tokenSpans': [token.span for token in
-                                getattr(listing.tokens, field)]}
-            listing.candidates.sort(key=lambda p: p.id)
-            item['candidateKeys'] = [product.id for
-                    product in listing.candidates]
-            if listing.best_candidate != None:
-                item['bestCandidateKey'] = listing.best_candidate.id
-        out_file.write('var listings = %s;\n' % (json.dumps(listing_items,
-                ensure_ascii=False)))
+                item.extend([getattr(listing, field),
+                        self.flat_token_spans(getattr(listing.tokens, field))])
+            best = listing.best_candidate
+            item.append(sorted((positions[id(product)]
+                    for product in listing.candidates),
+                    key=lambda position: self.products[position].id))
+            item.append(-1 if best == None else positions[id(best)])
+            group_index = self.viewer_group(listing)
+            chunks[group_index].append(item)
+            if len(chunks[group_index]) == chunk_size:
+                write_chunk(group_index)
+        for group_index, chunk in enumerate(chunks):
+            if chunk:
+                write_chunk(group_index)
+
+    @staticmethod
+    def flat_token_spans(tokens):
+        """Make a flat list of the start and end indices of tokens."""
+        spans = []
+        for token in tokens:
+            spans.extend(token.span)
+        return spans
+
+    # The groups of listings shown by the viewer, in order, with a name
+    #  for the files of a paged viewer, a header, and a plural suffix.
+    viewer_groups = [('unresolved', 'Unresolved multiple', 's'),
+            ('resolved', 'Resolved multiple', 's'),
+            ('single', 'Single', ''), ('none', 'No', '')]
+
+    @staticmethod
+    def viewer_group(listing):
+        """Get the index of the viewer group that a listing belongs to."""
+        count = len(listing.candidates)
+        if count == 0:
+            return 3
+        elif count == 1:
+            return 2
+        elif listing.best_candidate != None:
+            return 1
+        else:
+            return 0
+
+    def count_viewer_groups(self):
+        """Count the listings in each viewer group. Return a list of the
+        header texts of the groups, which include the counts.
+        """
+        counts = [0] * len(self.viewer_groups)
+        for listing in self.listings:
+            counts[self.viewer_group(listing)] += 1
+        total_count = max(len(self.listings), 1)
+        header_texts = []
+        for (name, header_text, plural), count in zip(self.viewer_groups,
+                counts):
+            header_texts.append('%s candidate%s: %d listing%s (%.1f%%)' % (
+                    header_text, plural, count, '' if count == 1 else 's',
+                    100.0 * count / total_count))
+        return counts, header_texts
 
     def write_viewer_html(self, out_file, header, footer):
-        """Generate a static HTML file displaying listings with candidates."""
+        """Generate a static HTML file displaying listings with candidates.
+        The HTML is written one listing at a time.
+        """
+        counts, header_texts = self.count_viewer_groups()
+        groups = [[] for group in self.viewer_groups]
+        for listing in sorted(self.listings, key=lambda x: x.id):
+            groups[self.viewer_group(listing)].append(listing)
         # Make a wrapper for everything.
         wrapper = HTMLNode('div', {'id': 'wrapper'})
+        out_file.write(header)
+        out_file.write(wrapper.opening_text(0, 3))
         # Add a spinner to bide the time while the listings load.
-        spinner = HTMLNode('div', {'id': 'spinner'})
-        wrapper.add(spinner)
-        # Make nodes to contain listings grouped by candidate count.
-        multiple_unresolved = self.make_group_node('Unresolved multiple', 's')
-        multiple_resolved = self.make_group_node('Resolved multiple', 's')
-        one = self.make_group_node('Single')
-        zero = self.make_group_node('No')
-        for listing in sorted(self.listings, key=lambda x: x.id):
-            # Select the appropriate group for this listing.
-            count = len(listing.candidates)
-            if count == 0:
-                group = zero
-            elif count == 1:
-                group = one
-            elif listing.best_candidate != None:
-                group = multiple_resolved
-            else:
-                group = multiple_unresolved
-            # Make a node to contain the listing and its candidate products.
-            container = HTMLNode('div', {'class': 'listingContainer'})
-            group.add(container)
-            # Make a node for the listing itself.
-            listing_node = HTMLNode('div', {'class': 'listing'},
-                    [self.make_pair_node('listing', listing.id, 'id')])
-            container.add(listing_node)
-            # Store text fragments for later use in highlighting the listing.
-            highlight_maps = Container({'manufacturer': {}, 'title': {}})
-            for product in sorted(listing.candidates, key=lambda x: x.id):
-                # Make a node for the product.
-                class_text = 'product'
-                if product == listing.best_candidate:
-                    class_text += ' selected'
-                group_node = HTMLNode('div', {'class': class_text},
-                        [self.make_pair_node('product', product.id, 'id')])
-                container.add(group_node)
-                # Add the product fields.
-                for name in ['manufacturer', 'family', 'model']:
-                    # There may be no family.
-                    if not hasattr(product, name):
-                        continue
-                    text = getattr(product, name)
-                    text_lower = text.lower()
-                    # Highlight text fragments and save for later use.
-                    if name == 'manufacturer':
-                        highlight_map = highlight_maps.manufacturer
-                    else:
-                        highlight_map = highlight_maps.title
-                    for token in reversed(getattr(product.tokens, name)):
-                        a, b = token.span
-                        highlight_map[text_lower[a:b]] = name
-                        text = self.insert_highlighting(text, a, b, name)
-                    group_node.add(self.make_pair_node(name, text, name))
-            # Highlight listing fields and turn them into nodes.
-            for name in ['manufacturer', 'title']:
-                highlight_map = getattr(highlight_maps, name)
-                text = getattr(listing, name)
+        out_file.write(HTMLNode('div', {'id': 'spinner'}).to_text(1, 3))
+        for header_text, listings in zip(header_texts, groups):
+            group = self.make_group_node(header_text)
+            out_file.write(group.opening_text(1, 3))
+            out_file.write(group.children[0].to_text(2, 3))
+            for listing in listings:
+                out_file.write(self.make_listing_node(listing).to_text(2, 3))
+            out_file.write(group.closing_text(1, 3))
+        out_file.write(wrapper.closing_text(0, 3))
+        out_file.write(footer)
+
+    def write_viewer_pages(self, viewer_dir, header, footer, page_size):
+        """Generate a static HTML index of the viewer groups, linking to
+        pages of at most page_size listings each. The pages of all groups
+        are written in a single pass over the listings.
+        """
+        counts, header_texts = self.count_viewer_groups()
+        page_counts = [(count + page_size - 1) // page_size
+                for count in counts]
+        def page_name(group_index, page):
+            return 'listings-%s-%d.html' % (
+                    self.viewer_groups[group_index][0], page)
+        # Remove the pages of a previous run.
+        for name in os.listdir(viewer_dir):
+            if re.match('^listings-[a-z]+-[0-9]+[.]html$', name):
+                os.remove(os.path.join(viewer_dir, name))
+        # The index lists the groups with links to their pages.
+        wrapper = HTMLNode('div', {'id': 'wrapper'},
+                [HTMLNode('div', {'id': 'spinner'})])
+        for group_index, header_text in enumerate(header_texts):
+            group = self.make_group_node(header_text)
+            links = HTMLNode('div', {'class': 'pages'})
+            for page in range(1, page_counts[group_index] + 1):
+                links.add(HTMLNode('a', {'href': page_name(group_index, page)},
+                        [str(page)]))
+            group.add(links)
+            wrapper.add(group)
+        with open(os.path.join(viewer_dir, 'listings.html'), 'w') as out_file:
+            out_file.write(header)
+            out_file.write(wrapper.to_text(indent_to_depth=3))
+            out_file.write(footer)
+        # Each group has at most one page open at a time.
+        page_files = [None] * len(self.viewer_groups)
+        page_numbers = [0] * len(self.viewer_groups)
+        page_listings = [0] * len(self.viewer_groups)
+        def navigation_text(group_index):
+            page = page_numbers[group_index]
+            navigation = HTMLNode('div', {'class': 'navigation'},
+                    [HTMLNode('a', {'href': 'listings.html'}, ['index'])])
+            if page > 1:
+                navigation.add(HTMLNode('a', {'href':
+                        page_name(group_index, page - 1)}, ['previous']))
+            if page < page_counts[group_index]:
+                navigation.add(HTMLNode('a', {'href':
+                        page_name(group_index, page + 1)}, ['next']))
+            return navigation.to_text(1, 3)
+        def close_page(group_index):
+            out_file = page_files[group_index]
+            out_file.write(group_node.closing_text(1, 3))
+            out_file.write(navigation_text(group_index))
+            out_file.write(wrapper.closing_text(0, 3))
+            out_file.write(footer)
+            out_file.close()
+        group_node = HTMLNode('div', {'class': 'group'})
+        try:
+            for listing in sorted(self.listings, key=lambda x: x.id):
+                group_index = self.viewer_group(listing)
+                out_file = page_files[group_index]
+                if out_file == None or page_listings[group_index] == page_size:
+                    if out_file != None:
+                        close_page(group_index)
+                    page_numbers[group_index] += 1
+                    page_listings[group_index] = 0
+                    page = page_numbers[group_index]
+                    out_file = page_files[group_index] = open(os.path.join(
+                            viewer_dir, page_name(group_index, page)), 'w')
+                    out_file.write(header)
+                    out_file.write(wrapper.opening_text(0, 3))
+                    out_file.write(HTMLNode('div', {'id': 'spinner'}).to_text(
+                            1, 3))
+                    out_file.write(navigation_text(group_index))
+                    out_file.write(group_node.opening_text(1, 3))
+                    out_file.write(HTMLNode('h2', {'class': 'header'},
+                            ['%s, page %d of %d' % (header_texts[group_index],
+                            page, page_counts[group_index])]).to_text(2, 3))
+                out_file.write(self.make_listing_node(listing).to_text(2, 3))
+                page_listings[group_index] += 1
+            for group_index, out_file in enumerate(page_files):
+                if out_file != None:
+                    close_page(group_index)
+                    page_files[group_index] = None
+        finally:
+            for out_file in page_files:
+                if out_file != None:
+                    out_file.close()
+
+    def make_listing_node(self, listing):
+        """Represent a listing and its candidate products in HTML, with the
+        matching parts of the text highlighted.
+        """
+        # Make a node to contain the listing and its candidate products.
+        container = HTMLNode('div', {'class': 'listingContainer'})
+        # Make a node for the listing itself.
+        listing_node = HTMLNode('div', {'class': 'listing'},
+                [self.make_pair_node('listing', listing.id, 'id')])
+        container.add(listing_node)
+        # Store text fragments for later use in highlighting the listing.
+        highlight_maps = Container({'manufacturer': {}, 'title': {}})
+        for product in sorted(listing.candidates, key=lambda x: x.id):
+            # Make a node for the product.
+            class_text = 'product'
+            if product == listing.best_candidate:
+                class_text += ' selected'
+            group_node = HTMLNode('div', {'class': class_text},
+                    [self.make_pair_node('product', product.id, 'id')])
+            container.add(group_node)
+            # Add the product fields.
+            for name in ['manufacturer', 'family', 'model']:
+                # There may be no family.
+                if not hasattr(product, name):
+                    continue
+                text = getattr(product, name)
                 text_lower = text.lower()
-                for token in reversed(getattr(listing.tokens, name)):
+                # Highlight text fragments and save for later use.
+                if name == 'manufacturer':
+                    highlight_map = highlight_maps.manufacturer
+                else:
+                    highlight_map = highlight_maps.title
+                for token in reversed(getattr(product.tokens, name)):
                     a, b = token.span
-                    key = text_lower[a:b]
-                    if key in highlight_map:
-                        field_name = highlight_map[key]
-                        text = self.insert_highlighting(text, a, b, field_name)
-                if name == 'title':
-                    listing_node.add('<br>')
-                listing_node.add(self.make_pair_node(name, text, name))
-        # Alter each group header to show the number of listings it contains.
-        total_count = len(self.listings)
-        for group in [multiple_unresolved, multiple_resolved, one, zero]:
-            count = len(group.children) - 1
-            count_text = ': %d listing%s (%.1f%%)' % (count,
-                    '' if count == 1 else 's', 100.0 * count / total_count)
-            group.children[0].children[0] += count_text
-            wrapper.add(group)
-        out_file.write(header)
-        out_file.write(wrapper.to_text(indent_to_depth=3))
-        out_file.write(footer)
+                    highlight_map[text_lower[a:b]] = name
+                    text = self.insert_highlighting(text, a, b, name)
+                group_node.add(self.make_pair_node(name, text, name))
+        # Highlight listing fields and turn them into nodes.
+        for name in ['manufacturer', 'title']:
+            highlight_map = getattr(highlight_maps, name)
+            text = getattr(listing, name)
+            text_lower = text.lower()
+            for token in reversed(getattr(listing.tokens, name)):
+                a, b = token.span
+                key = text_lower[a:b]
+                if key in highlight_map:
+                    field_name = highlight_map[key]
+                    text = self.insert_highlighting(text, a, b, field_name)
+            if name == 'title':
+                listing_node.add('<br>')
+            listing_node.add(self.make_pair_node(name, text, name))
+        return container
 
     @staticmethod
-    def make_group_node(header_text, plural=''):
+    def make_group_node(header_text):
         """Represent a group of listings in HTML."""
         return HTMLNode('div', {'class': 'group'},
-                [HTMLNode('h2', {'class': 'header'},
-                        [header_text + ' candidate' + plural])])
+                [HTMLNode('h2', {'class': 'header'}, [header_text])])
 
     @staticmethod
     def make_pair_node(key, value, class_extra=None):
@@ -356,42 +1159,64 @@ class Matcher:
 class LooseMatcher(Matcher):
     """Implements matching rules that prefer recall to precision."""
 
-    @staticmethod
-    def may_match(listing, product):
+    def may_match(self, listing, product):
         """Decide whether a listing is potentially matched by a product."""
         # If a listing's manufacturer and title tokens include a product's
         #  manufacturer and model tokens, respectively, as sublists, we
         #  consider the product to be a potential match for the listing.
-        if Matcher.find(listing.tokens.manufacturer,
-                product.tokens.manufacturer) == -1:
+        rule, tokens = product.rule, listing.tokens
+        if rule.manufacturer_group not in self.manufacturers.resolve(
+                tokens.manufacturer):
+            return False
+        return Matcher.find(tokens.title, rule.model) != -1
+
+    def may_match_batch(self, positions, product):
+        """Decide which of the listings at the given positions are
+        potentially matched by a product. Return an array of booleans.
+        """
+        rule = product.rule
+        return (Matcher.find_batch(self.title_matrix[positions],
+                rule.model).any(1) &
+                Matcher.find_batch(self.manufacturer_matrix[positions],
+                rule.manufacturer).any(1))
+
+    def may_match_found(self, listing, product, model_starts, family_starts):
+        """Decide on a match given the positions of the model tokens."""
+        if len(model_starts) == 0:
             return False
-        return Matcher.find(listing.tokens.title, product.tokens.model) != -1
+        return product.rule.manufacturer_group in self.manufacturers.resolve(
+                listing.tokens.manufacturer)
+
+    def may_match_span(self, listing, product, start, end):
+        """Decide on a match given that the title tokens from start to end
+        were found to be close to the model tokens by match_fuzzy().
+        """
+        return product.rule.manufacturer_group in self.manufacturers.resolve(
+                listing.tokens.manufacturer)
 
     @staticmethod
     def compare_details(listing, a, b):
         """Decide whether one product is a closer match than another."""
+        a, b = a.rule, b.rule
         # Does one product have a family match whereas the other does not?
-        a_family_match = (hasattr(a.tokens, 'family') and
-                Matcher.find(listing.tokens.title, a.tokens.family) >= 0)
-        b_family_match = (hasattr(b.tokens, 'family') and
-                Matcher.find(listing.tokens.title, b.tokens.family) >= 0)
+        title_tokens = listing.tokens.title
+        a_family_match = (a.family != None and
+                Matcher.find(title_tokens, a.family) >= 0)
+        b_family_match = (b.family != None and
+                Matcher.find(title_tokens, b.family) >= 0)
         if a_family_match and not b_family_match:
             return -1
         if not a_family_match and b_family_match:
             return 1
         # Does one product have more tokens than the other?
-        a_num_tokens = len(a.tokens.model)
-        b_num_tokens = len(b.tokens.model)
-        if a_num_tokens > b_num_tokens:
+        if a.model_length > b.model_length:
             return -1
-        if a_num_tokens < b_num_tokens:
+        if a.model_length < b.model_length:
             return 1
         # Does one product have a longer model name than the other?
-        a_total_length = sum(len(token.text) for token in a.tokens.model)
-        b_total_length = sum(len(token.text) for token in b.tokens.model)
-        if a_total_length > b_total_length:
+        if a.model_text_length > b.model_text_length:
             return -1
-        if a_total_length < b_total_length:
+        if a.model_text_length < b.model_text_length:
             return 1
         return 0
 
@@ -399,160 +1224,1975 @@ class LooseMatcher(Matcher):
 class TightMatcher(Matcher):
     """Implements matching rules that prefer precision to recall."""
 
-    @staticmethod
-    def may_match(listing, product):
+    # A product's family tokens must be in the title along with the model.
+    index_fields = Matcher.index_fields + [('title', 'family')]
+
+    def compile_products(self):
+        """Compile the products, then make a table of the products whose
+        model tokens are a sublist of each product's model tokens, for use by
+        compare_details().
+        """
+        super().compile_products()
+        # Rather than compare every pair of products, we look up each sublist
+        #  of a product's model tokens in a map of model tokens to products.
+        #  Model names are a few tokens long, so there are few sublists.
+        model_products = {}
+        for product in self.products:
+            model_products.setdefault(tuple(product.rule.model.ids),
+                    []).append(product)
+        for product in self.products:
+            ids = tuple(product.rule.model.ids)
+            dominates = set(model_products.get((), []))
+            for start in range(len(ids)):
+                for end in range(start + 1, len(ids) + 1):
+                    dominates.update(model_products.get(ids[start:end], []))
+            product.rule.dominates = dominates
+
+    def may_match(self, listing, product):
         """Decide whether a listing is potentially matched by a product."""
         # If the product has a family value, we require that it be present
         #  in the listing and that it occur immediately before or after the
         #  model value. The other criteria are the same as for loose matching.
+        rule = product.rule
         title_tokens = listing.tokens.title
-        model_tokens = product.tokens.model
-        model_starts = Matcher.find_all(title_tokens, model_tokens)
+        model_starts = Matcher.find_all(title_tokens, rule.model)
         if len(model_starts) == 0:
             return False
-        if hasattr(product, 'family'):
-            family_tokens = product.tokens.family
-            family_starts = Matcher.find_all(title_tokens, family_tokens)
+        family_starts = None
+        if rule.family != None:
+            family_starts = Matcher.find_all(title_tokens, rule.family)
+        # Call the rule directly. Metrics count calls made by the engines.
+        return TightMatcher.may_match_found(self, listing, product,
+                model_starts, family_starts)
+
+    def may_match_batch(self, positions, product):
+        """Decide which of the listings at the given positions are
+        potentially matched by a product. Return an array of booleans.
+        """
+        rule = product.rule
+        titles = self.title_matrix[positions]
+        model_found = Matcher.find_batch(titles, rule.model)
+        if rule.family != None:
+            # A family occurrence must end where a model occurrence starts,
+            #  or start where one ends.
+            family_found = Matcher.find_batch(titles, rule.family)
+            width = titles.shape[1]
+            result = ((family_found[:, :max(0, width - rule.family_length)] &
+                    model_found[:, rule.family_length:]).any(1) |
+                    (model_found[:, :max(0, width - rule.model_length)] &
+                    family_found[:, rule.model_length:]).any(1))
+        else:
+            result = model_found.any(1)
+        return result & Matcher.find_batch(self.manufacturer_matrix[positions],
+                rule.manufacturer).any(1)
+
+    def may_match_found(self, listing, product, model_starts, family_starts):
+        """Decide on a match given the positions of the model and family
+        tokens. The adjacency of family and model is checked directly.
+        """
+        if len(model_starts) == 0:
+            return False
+        rule = product.rule
+        if rule.family != None:
             if len(family_starts) == 0:
                 return False
             # Check every family occurrence to see if it immediately precedes
             #  or succeeds any of the model occurrences.
             found = False
             model_start_set = set(model_starts)
-            num_family_tokens = len(family_tokens)
-            num_model_tokens = len(model_tokens)
+            family_length, model_length = rule.family_length, rule.model_length
             for family_start in family_starts:
-                if (family_start + num_family_tokens in model_start_set or
-                        family_start - num_model_tokens in model_start_set):
+                if (family_start + family_length in model_start_set or
+                        family_start - model_length in model_start_set):
                     found = True
                     break
             if not found:
                 return False
-        return Matcher.find(listing.tokens.manufacturer,
-                product.tokens.manufacturer) != -1
+        return rule.manufacturer_group in self.manufacturers.resolve(
+                listing.tokens.manufacturer)
+
+    def may_match_span(self, listing, product, start, end):
+        """Decide on a match given that the title tokens from start to end
+        were found to be close to the model tokens by match_fuzzy(). The
+        family must be right before or after them, though its tokens may
+        be joined or split differently, as long as the text is the same.
+        """
+        rule = product.rule
+        if rule.family != None:
+            family_text = ''.join(token.text for token in rule.family)
+            title_tokens = listing.tokens.title
+            # Each title token holds at least one character of the family.
+            for length in range(1, len(family_text) + 1):
+                if family_text in (
+                        Matcher.joined_text(title_tokens, start - length,
+                        start), Matcher.joined_text(title_tokens, end,
+                        end + length)):
+                    break
+            else:
+                return False
+        return rule.manufacturer_group in self.manufacturers.resolve(
+                listing.tokens.manufacturer)
 
     @staticmethod
     def compare_details(listing, a, b):
         """Decide whether one product is a closer match than another."""
+        a_rule, b_rule = a.rule, b.rule
         # Does one have a family match whereas the other does not?
-        a_family_match = (hasattr(a.tokens, 'family') and
-                Matcher.find(listing.tokens.title, a.tokens.family) >= 0)
-        b_family_match = (hasattr(b.tokens, 'family') and
-                Matcher.find(listing.tokens.title, b.tokens.family) >= 0)
+        title_tokens = listing.tokens.title
+        a_family_match = (a_rule.family != None and
+                Matcher.find(title_tokens, a_rule.family) >= 0)
+        b_family_match = (b_rule.family != None and
+                Matcher.find(title_tokens, b_rule.family) >= 0)
         if a_family_match and not b_family_match:
             return -1
         if not a_family_match and b_family_match:
             return 1
-        # Is one model a strict superlist of the other model?
-        if Matcher.find(a.tokens.model, b.tokens.model) >= 0:
+        # Is one model a strict superlist of the other model? This depends
+        #  only on the products, so it was worked out by compile_products().
+        if b in a_rule.dominates:
             return -1
-        if Matcher.find(b.tokens.model, a.tokens.model) >= 0:
+        if a in b_rule.dominates:
             return 1
         return 0
 
 
-class HTMLNode:
-    """A simple representation of an HTML element, containing just enough
-    information to print out static HTML.
+class TokenAutomaton:
+    """An Aho-Corasick automaton over tokens. It finds every occurrence of
+    a fixed set of token sequences in a single pass over a list of tokens,
+    so the cost of a search doesn't depend on the number of sequences.
     """
 
-    one_indent = '  '  # The unit of indentation.
+    def __init__(self, sequences):
+        """Build a trie of the given sequences and add failure links."""
+        self.goto = [{}]  # Each state's transitions, keyed by token ID.
+        self.outputs = [[]]  # The sequences that end in each state.
+        self.empty = []  # Empty sequences occur at every position.
+        for sequence_index, sequence in enumerate(sequences):
+            if len(sequence) == 0:
+                self.empty.append(sequence_index)
+                continue
+            state = 0
+            for key in sequence:
+                next_state = self.goto[state].get(key)
+                if next_state == None:
+                    next_state = len(self.goto)
+                    self.goto[state][key] = next_state
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append((sequence_index, len(sequence)))
+        # The failure link of a state points to the state of the longest
+        #  proper suffix that is also in the trie. We compute the links in
+        #  breadth-first order, so shorter suffixes are always done first.
+        self.fail = len(self.goto) * [0]
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for key, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail != 0 and key not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(key, 0)
+                self.fail[next_state] = fail
+                self.outputs[next_state] = (self.outputs[next_state] +
+                        self.outputs[fail])
 
-    def __init__(self, name, attributes=None, children=None):
-        """Make a specified type of HTML element. Optionally set its
-        dictionary of attribute strings and list of child elements.
+    def find_all(self, keys):
+        """Search a list of tokens for all sequences. Return a dictionary
+        that maps the index of each sequence found to a list of start indices.
         """
-        self.name = name
-        self.attributes = attributes or {}
-        self.children = children or []
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        found = {}
+        state = 0
+        for position, key in enumerate(keys):
+            while True:
+                next_state = goto[state].get(key)
+                if next_state != None:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            for sequence_index, length in outputs[state]:
+                found.setdefault(sequence_index, []).append(
+                        position - length + 1)
+        for sequence_index in self.empty:
+            found[sequence_index] = list(range(len(keys) + 1))
+        return found
 
-    def add(self, node):
-        """Add a given HTML node as a child of this one."""
-        self.children.append(node)
 
-    def to_text(self, depth=0, indent_to_depth=0):
-        """Recursively generate a text representation of this HTML node.
-        Indentation is done to the maximum depth specified by the optional
-        argument indent_to_depth. Upon reaching this depth, indentation ceases.
-        If indent_to_depth is omitted, there is no indentation at all.
-        """
-        parts = []
-        # Opening tag.
-        if depth < indent_to_depth:
-            parts.extend(depth * [self.one_indent])
-        parts.extend(['<', self.name])
-        for key, value in self.attributes.items():
-            parts.extend([' ', key, '="', value, '"'])
-        parts.append('>')
-        if depth < indent_to_depth:
-            parts.append('\n')
-        # Children.
-        for child in self.children:
-            if type(child) == HTMLNode:
-                parts.append(child.to_text(depth + 1, indent_to_depth))
-            else:
-                if depth < indent_to_depth:
-                    parts.extend((depth + 1) * [self.one_indent])
-                parts.append(str(child))
-                if depth < indent_to_depth:
-                    parts.append('\n')
-        # Closing tag.
-        if depth < indent_to_depth:
-            parts.extend(depth * [self.one_indent])
-        parts.extend(['</', self.name, '>'])
-        if depth < indent_to_depth:
-            parts.append('\n')
-        # Done.
-        return ''.join(parts)
+class FuzzyModelIndex:
+    """Finds the products whose model tokens, joined together, are within
+    one edit of the joined text of a run of listing tokens. Joining makes
+    "SX130 IS" and "SX130IS" alike, as well as "DSC-W310" and "DSCW310".
+    Model numbers that differ by a digit are different models, and so are
+    those that differ by a letter in a short token, such as DSC-H70 and
+    DSC-S70, so only the letters of long tokens can be edited.
+    """
 
+    edit_minimum = 5  # Shorter keys are only matched without edits.
+    edit_token_minimum = 4  # Shorter tokens are only matched without edits.
 
-class Container:
-    """A bag of unspecified attributes. Convenient for grouping data."""
+    def __init__(self, products):
+        """Index the joined model tokens of a list of compiled products."""
+        self.products = collections.OrderedDict()
+        # For each character of a key, the length of its token.
+        self.token_lengths = {}
+        for product in products:
+            texts = [token.text for token in product.rule.model]
+            key = ''.join(texts)
+            if key not in self.products:
+                self.products[key] = []
+                self.token_lengths[key] = [len(text) for text in texts
+                        for char in text]
+            self.products[key].append(product)
+        # Keys that can be edited are put in buckets by their digits, their
+        #  first two or last two characters, and their length. An edit
+        #  leaves one pair or the other alone, so a text is only compared
+        #  with the keys in a few buckets, whatever the number of products.
+        self.buckets = {}
+        self.digit_prefixes = set()
+        # For the digits of each key, the lengths of the texts that may be
+        #  within one edit of a key with those digits.
+        self.text_lengths = {}
+        for key in self.products:
+            digits = self.digits(key)
+            for i in range(len(digits) + 1):
+                self.digit_prefixes.add(digits[:i])
+            lengths = self.text_lengths.setdefault(digits, set())
+            lengths.add(len(key))
+            if len(key) < self.edit_minimum:
+                continue
+            lengths.update([len(key) - 1, len(key) + 1])
+            for pair in (key[:2], key[-2:]):
+                bucket = self.buckets.setdefault((digits, pair),
+                        {}).setdefault(len(key), [])
+                if key not in bucket:
+                    bucket.append(key)
+        self.max_length = max([0] + [len(key) for key in self.products])
 
-    def __init__(self, data=None):
-        """Given a dictionary, use keys and values to initialize attributes."""
-        if data:
-            for name, value in data.items():
-                setattr(self, name, value)
+    @staticmethod
+    def digits(text):
+        """Get the digits of a text."""
+        return ''.join(char for char in text if char in Parser.digit_set)
 
+    @staticmethod
+    def texts(token_list):
+        """Get the texts of a token list for find(). Tokens that aren't in
+        the vocabulary end runs of tokens.
+        """
+        strings = Parser.vocabulary.strings
+        return [None if token_id == -1 else strings[token_id]
+                for token_id in token_list.ids]
 
-class Product(Container):
-    """Contains a product's raw data and tokens for use in matching."""
+    def find(self, texts, budget):
+        """Find the runs of a list of token texts that are within one edit
+        of a model key, where None marks a token that can't be in a run.
+        Return a list of (start, end, key) tuples, or None if more than
+        budget runs would have to be looked up.
+        """
+        spans = []
+        lookups = 0
+        for start in range(len(texts)):
+            text = digits = ''
+            previous_is_digits = False
+            for end in range(start + 1, len(texts) + 1):
+                token_text = texts[end - 1]
+                if token_text == None:
+                    break
+                text += token_text
+                if len(text) > self.max_length + 1:
+                    break
+                # Numbers such as 10.0 are not joined. A run ends when no
+                #  model's digits begin with the digits in it.
+                is_digits = token_text[0] in Parser.digit_set
+                if is_digits:
+                    if previous_is_digits:
+                        break
+                    digits += token_text
+                    if digits not in self.digit_prefixes:
+                        break
+                previous_is_digits = is_digits
+                # Most runs of tokens are ruled out by their length.
+                if len(text) not in self.text_lengths.get(digits, ()):
+                    continue
+                lookups += 1
+                if lookups > budget:
+                    return None
+                for key in self.lookup(text, digits):
+                    spans.append((start, end, key))
+        return spans
 
-    def __init__(self, data):
-        """Store attributes and tokenize those used in matching."""
-        super().__init__(data)
-        Parser.tokenize_attributes(self, 'manufacturer', 'family', 'model')
+    def lookup(self, text, digits):
+        """Get the model keys that are within one edit of a text, given the
+        digits of the text.
+        """
+        keys = [text] if text in self.products else []
+        if len(text) + 1 < self.edit_minimum:
+            return keys
+        for pair in (text[:2], text[-2:]):
+            buckets = self.buckets.get((digits, pair))
+            if buckets == None:
+                continue
+            for length in (len(text) - 1, len(text), len(text) + 1):
+                for key in buckets.get(length, ()):
+                    if key not in keys and self.within_one_edit(text, key):
+                        keys.append(key)
+        return keys
+
+    def within_one_edit(self, text, key):
+        """Decide whether a letter of a long key token can be substituted
+        or deleted, or a letter inserted next to one, to turn a key into a
+        text that has the same digits.
+        """
+        i = 0
+        while i < min(len(text), len(key)) and text[i] == key[i]:
+            i += 1
+        if len(text) == len(key):
+            same, positions = text[i + 1:] == key[i + 1:], (i,)
+        elif len(text) < len(key):
+            same, positions = text[i:] == key[i + 1:], (i,)
+        else:
+            same, positions = text[i + 1:] == key[i:], (i - 1, i)
+        token_lengths = self.token_lengths[key]
+        return same and any(0 <= position < len(key) and
+                key[position] in Parser.letter_set and
+                token_lengths[position] >= self.edit_token_minimum
+                for position in positions)
+
+
+class ResultSpill:
+    """Accumulates matched listings in sorted run files on disk and merges
+    them into results that are identical to those of write_results(). Only
+    one chunk of listings and one group of results are held in memory.
+    """
+
+    merge_limit = 32  # The maximum number of runs merged at once.
+    decoder = json.JSONDecoder()
+
+    def __init__(self, directory=None):
+        """Prepare to write run files to a directory, by default the system's
+        temporary directory.
+        """
+        self.directory = directory
+        # Runs are kept in levels of a log-structured merge. Runs at level k
+        #  have been merged k times. Every run at a higher level holds
+        #  listings that came before those in the runs at lower levels.
+        self.levels = []
+
+    def add(self, listings):
+        """Write the listings that have a best candidate to a sorted run."""
+        lines = []
+        for listing in listings:
+            product = listing.best_candidate
+            if product == None:
+                continue
+            # The position breaks ties, so that listings with the same
+            #  product name stay in their original order.
+            lines.append((product.product_name, len(lines), json.dumps(
+                    product.product_name, ensure_ascii=False), json.dumps(
+                    listing.result_data, ensure_ascii=False)))
+        if len(lines) == 0:
+            return
+        lines.sort()
+        self.add_run(0, self.write_run(lines))
+
+    def add_run(self, level, path):
+        """Put a run at a given level. Merge the level if it's full."""
+        while len(self.levels) <= level:
+            self.levels.append([])
+        runs = self.levels[level]
+        runs.append(path)
+        if len(runs) < self.merge_limit:
+            return
+        self.levels[level] = []
+        self.add_run(level + 1, self.write_run(self.merge(runs)))
+        for path in runs:
+            os.remove(path)
+
+    def write_run(self, lines):
+        """Write sorted tuples to a new run file. Return the file's path."""
+        fd, path = tempfile.mkstemp(prefix='spill.', suffix='.txt',
+                dir=self.directory)
+        with open(fd, 'w', encoding='utf-8', newline='\n') as run_file:
+            for line in lines:
+                run_file.write('%s\t%s\n' % line[-2:])
+        return path
+
+    @staticmethod
+    def read_run(path, run_index):
+        """Generate sortable tuples from the lines of a run file."""
+        with open(path, encoding='utf-8', newline='\n') as run_file:
+            for position, line in enumerate(run_file):
+                # JSON encoding escapes tabs, so the first one is a separator.
+                name_text, data_text = line[:-1].split('\t', 1)
+                yield (json.loads(name_text), run_index, position,
+                        name_text, data_text)
+
+    def merge(self, runs):
+        """Merge runs that are given in order, oldest first."""
+        return heapq.merge(*[self.read_run(path, run_index)
+                for run_index, path in enumerate(runs)])
+
+    def write(self, out_file):
+        """Merge all runs to write results in the challenge format."""
+        runs = []
+        for level_runs in reversed(self.levels):
+            runs.extend(level_runs)
+        self.write_groups(self.merge(runs), out_file)
+
+    @staticmethod
+    def write_groups(items, out_file):
+        """Write lines of results from sorted tuples that start with a
+        product name and end with the JSON-encoded name and listings. The
+        listings of consecutive tuples with the same name are joined.
+        """
+        group_name, group_text, group = None, None, []
+        wrote_group = False
+        for item in items:
+            name, name_text, data_text = item[0], item[-2], item[-1]
+            if name != group_name and group:
+                out_file.write(ResultSpill.format_group(group_text, group))
+                wrote_group = True
+                group = []
+            group_name, group_text = name, name_text
+            group.append(data_text)
+        if group:
+            out_file.write(ResultSpill.format_group(group_text, group))
+            wrote_group = True
+        # Match the output of write_results() when there are no results.
+        if not wrote_group:
+            out_file.write('\n')
+
+    @staticmethod
+    def parse_group_name(line):
+        """Extract the product name from a line of results."""
+        prefix = '{"product_name": '
+        if not line.startswith(prefix):
+            raise ValueError('not a line of results: %s' % line[:80])
+        return ResultSpill.decoder.raw_decode(line, len(prefix))[0]
+
+    @staticmethod
+    def split_group(line):
+        """Split a line of results into the product name, the JSON-encoded
+        product name, and the JSON-encoded listings without brackets.
+        """
+        prefix, infix, suffix = '{"product_name": ', ', "listings": [', ']}\n'
+        if not line.startswith(prefix):
+            raise ValueError('not a line of results: %s' % line[:80])
+        name, end = ResultSpill.decoder.raw_decode(line, len(prefix))
+        if (not line.startswith(infix, end) or not line.endswith(suffix) or
+                end + len(infix) > len(line) - len(suffix)):
+            raise ValueError('not a line of results: %s' % line[:80])
+        return (name, line[len(prefix):end],
+                line[end + len(infix):-len(suffix)])
+
+    @staticmethod
+    def read_results(path, file_index):
+        """Generate sortable tuples from the groups of a results file."""
+        with open(path) as in_file:
+            for line in in_file:
+                # A file without results consists of a newline.
+                if line == '\n':
+                    continue
+                name, name_text, listings_text = ResultSpill.split_group(line)
+                yield name, file_index, name_text, listings_text
+
+    @staticmethod
+    def merge_results(paths, out_file):
+        """Merge results files, each made from a range of listings, into the
+        results of all the listings. The files must be given in the order of
+        their ranges. A product's listings may be in several files, so its
+        groups are joined, in file order, into one line.
+        """
+        ResultSpill.write_groups(heapq.merge(*[
+                ResultSpill.read_results(path, file_index)
+                for file_index, path in enumerate(paths)]), out_file)
+
+    @staticmethod
+    def format_group(name_text, listing_texts):
+        """Make a line of results from a JSON-encoded product name and a list
+        of JSON-encoded listings. The format is identical to json.dumps().
+        """
+        return '{"product_name": %s, "listings": [%s]}\n' % (name_text,
+                ', '.join(listing_texts))
+
+    def close(self):
+        """Delete all run files."""
+        for runs in self.levels:
+            for path in runs:
+                os.remove(path)
+        self.levels = []
+
+
+class ListingFile:
+    """A memory-mapped file of JSON lines with an index of line offsets.
+    Ranges of lines can be decoded and tokenized in parallel processes, and
+    a single listing can be read by ID without decoding the others.
+    """
+
+    parallel_minimum = 10000  # Fewer lines are not worth a process pool.
+    shards_per_worker = 4  # Smaller shards even out the load on workers.
+
+    def __init__(self, path):
+        """Map the file into memory and find the offset of each line."""
+        self.path = path
+        with open(path, 'rb') as in_file:
+            # Empty files can't be mapped.
+            self.map = (mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    if os.fstat(in_file.fileno()).st_size else b'')
+        self.line_offsets = self.find_line_offsets(self.map)
+        self.id_positions = None
+
+    @staticmethod
+    def find_line_offsets(data):
+        """Make an array of the offsets at which lines start, followed by the
+        offset at which the last line ends.
+        """
+        line_offsets = array.array('q', [0])
+        find = data.find
+        end = len(data)
+        offset = 0
+        while offset < end:
+            offset = find(b'\n', offset)
+            offset = end if offset == -1 else offset + 1
+            line_offsets.append(offset)
+        return line_offsets
+
+    def __len__(self):
+        return len(self.line_offsets) - 1
+
+    def read_data(self, position):
+        """Decode the line at a given position. Give it the line number as
+        its ID unless it has one of its own.
+        """
+        a, b = self.line_offsets[position:position + 2]
+        data = json.loads(self.map[a:b].decode('utf-8'))
+        if 'id' not in data:
+            data['id'] = position + 1
+        return data
+
+    def load(self, workers=1, start=0, end=None):
+        """Make a list of listings in line order, optionally from a range of
+        lines. With more than one worker, ranges of lines are decoded and
+        tokenized in worker processes.
+        """
+        if end == None:
+            end = len(self)
+        if workers < 2 or end - start < self.parallel_minimum:
+            listings = [Listing(self.read_data(position))
+                    for position in range(start, end)]
+        else:
+            listings = self.load_in_parallel(workers, start, end)
+        # Line numbers are the default IDs, so we only index other IDs.
+        if any(listing.id != position + 1
+                for position, listing in enumerate(listings, start)):
+            self.id_positions = dict((listing.id, position)
+                    for position, listing in enumerate(listings, start))
+        return listings
+
+    def load_in_parallel(self, workers, start, end):
+        """Tokenize ranges of lines in worker processes. Each worker has its
+        own vocabulary, which is merged into the parser's vocabulary in line
+        order, so that tokens get the same IDs as they would serially.
+        """
+        count = end - start
+        shard_count = min(workers * self.shards_per_worker, count)
+        bounds = [(start + i * count // shard_count,
+                start + (i + 1) * count // shard_count)
+                for i in range(shard_count)]
+        pool = multiprocessing.Pool(workers, ListingFile.start_worker,
+                (self.path, self.line_offsets))
+        listings = []
+        try:
+            intern = Parser.vocabulary.intern
+            for strings, records, tables in pool.imap(ListingFile.load_shard,
+                    bounds):
+                token_ids = [intern(text) for text in strings]
+                fields = []
+                for field in Snapshot.fields:
+                    ids, starts, offsets, choices = tables[field]
+                    ids = array.array('i', map(token_ids.__getitem__, ids))
+                    token_lists = [TokenList(ids[a:b], starts[a:b])
+                            for a, b in zip(offsets, offsets[1:])]
+                    fields.append((field, token_lists, choices))
+                for i, data in enumerate(records):
+                    tokens = TokenFields()
+                    for field, token_lists, choices in fields:
+                        if choices[i] != -1:
+                            setattr(tokens, field, token_lists[choices[i]])
+                    listings.append(Listing.from_tokens(data.pop('id'), data,
+                            tokens))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return listings
+
+    @staticmethod
+    def start_worker(path, line_offsets):
+        """Map the file in a worker, reusing the parent's line offsets."""
+        listing_file = ListingFile.__new__(ListingFile)
+        listing_file.path, listing_file.line_offsets = path, line_offsets
+        with open(path, 'rb') as in_file:
+            listing_file.map = mmap.mmap(in_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        ListingFile.worker_file = listing_file
+
+    @staticmethod
+    def load_shard(bounds):
+        """Decode and tokenize a range of lines in a worker process. Return
+        the strings of a new vocabulary, the decoded data, and a table of
+        tokens for each field.
+        """
+        # Pickling a Listing object for each line would cost more than
+        #  tokenizing it. Instead, the distinct token lists of each field are
+        #  concatenated into arrays, and each line gets the position of its
+        #  token list, or -1 if it lacks the field.
+        Parser.set_vocabulary(Vocabulary())
+        listing_file = ListingFile.worker_file
+        records = []
+        tables = dict((field, (array.array('i'), array.array('i'),
+                array.array('i', [0]), array.array('i'), {}))
+                for field in Snapshot.fields)
+        for position in range(*bounds):
+            data = listing_file.read_data(position)
+            records.append(data)
+            for field in Snapshot.fields:
+                ids, starts, offsets, choices, seen = tables[field]
+                text = data.get(field)
+                if text == None:
+                    choices.append(-1)
+                    continue
+                choice = seen.get(text)
+                if choice == None:
+                    choice = seen[text] = len(offsets) - 1
+                    tokens = Parser.text_to_tokens(text)
+                    ids.extend(tokens.ids)
+                    starts.extend(tokens.starts)
+                    offsets.append(len(ids))
+                choices.append(choice)
+        for field, table in tables.items():
+            tables[field] = table[:4]
+        return Parser.vocabulary.strings, records, tables
+
+    def shard_lines(self, index, count):
+        """Split the file into a number of shards of about the same size, at
+        line boundaries. Return the range of lines of the shard with a given
+        index, counting from zero.
+        """
+        size = self.line_offsets[-1]
+        return [bisect.bisect_left(self.line_offsets, size * i // count, 0,
+                len(self)) for i in (index, index + 1)]
+
+    @staticmethod
+    def find_shard(path, index, count):
+        """Find the shard of a file that shard_lines() would, without making
+        an index of line offsets. Return the byte offset and line index of
+        the shard's first line, and the number of lines in the shard.
+        """
+        # Only newlines are counted, so that streaming needs no memory in
+        #  proportion to the number of lines.
+        with open(path, 'rb') as in_file:
+            size = os.fstat(in_file.fileno()).st_size
+            if size == 0:
+                return 0, 0, 0
+            data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with data:
+            def line_start(position):
+                # Find the first line that starts at or after a position.
+                if position == 0 or position >= size:
+                    return position
+                newline = data.find(b'\n', position - 1)
+                return size if newline == -1 else newline + 1
+            def count_lines(a, b):
+                lines = 0
+                for block_start in range(a, b, 1 << 20):
+                    lines += data[block_start:min(b, block_start + (1 << 20))
+                            ].count(b'\n')
+                # The last line may lack a newline.
+                if b == size > a and data[size - 1:size] != b'\n':
+                    lines += 1
+                return lines
+            start = line_start(size * index // count)
+            end = line_start(size * (index + 1) // count)
+            return start, count_lines(0, start), count_lines(start, end)
+
+    def find(self, listing_id):
+        """Get the position of the listing with a given ID, or None."""
+        if self.id_positions == None:
+            # Try the line number first. If the ID isn't a line number, all
+            #  lines are decoded once to index the IDs.
+            if (isinstance(listing_id, int) and 0 < listing_id <= len(self)
+                    and self.read_data(listing_id - 1)['id'] == listing_id):
+                return listing_id - 1
+            self.id_positions = dict((self.read_data(position)['id'],
+                    position) for position in range(len(self)))
+        return self.id_positions.get(listing_id)
+
+    def get(self, listing_id):
+        """Make the listing with a given ID, or return None."""
+        position = self.find(listing_id)
+        return None if position == None else Listing(self.read_data(position))
+
+
+class ManufacturerResolver:
+    """Finds the product manufacturers that a listing's manufacturer
+    satisfies, that is, those whose tokens are a sublist of its tokens.
+    There are far fewer distinct listing manufacturers than listings, so each
+    is resolved once and the result is cached by token sequence.
+    """
+
+    cache_limit = 2**16  # Start over rather than let the cache grow forever.
+
+    def __init__(self):
+        """Start with no product manufacturers."""
+        self.groups = {}  # Maps a tuple of token IDs to a group number.
+        self.max_length = 0
+        self.cache = {}  # Maps listing manufacturer tokens to group sets.
+
+    def add(self, tokens):
+        """Get the group number of a product manufacturer, making a new group
+        if the manufacturer's tokens are new.
+        """
+        key = tuple(tokens.ids)
+        group = self.groups.get(key)
+        if group == None:
+            group = self.groups[key] = len(self.groups)
+            self.max_length = max(self.max_length, len(key))
+            # Cached sets lack the new group.
+            self.cache.clear()
+        return group
+
+    def resolve(self, tokens):
+        """Get the set of groups satisfied by a listing manufacturer's tokens.
+        """
+        ids = tokens.ids
+        key = ids.tobytes()
+        groups = self.cache.get(key)
+        if groups == None:
+            if len(self.cache) >= self.cache_limit:
+                self.cache.clear()
+            # Look up every sublist that is no longer than the longest product
+            #  manufacturer, including the empty sublist.
+            ids = tuple(ids)
+            get = self.groups.get
+            found = set()
+            for start in range(len(ids) + 1):
+                for end in range(start, min(len(ids),
+                        start + self.max_length) + 1):
+                    group = get(ids[start:end])
+                    if group != None:
+                        found.add(group)
+            groups = self.cache[key] = frozenset(found)
+        return groups
+
+
+class Snapshot:
+    """A binary file containing tokenized listings and their posting lists.
+    It is written after a run and memory-mapped by a later run on the same
+    listings file, which can then skip parsing, tokenizing, and indexing.
+
+    The file starts with a magic string and is followed by arrays of machine
+    integers, each aligned to eight bytes. A JSON header after the arrays
+    gives the position of each array, the vocabulary of token strings, and a
+    hash of the listings file. The file ends with the header's offset and
+    length, which makes it possible to write the arrays in a single pass.
+    """
+
+    magic = b'LSNAP001'
+    fields = ['manufacturer', 'title']
+
+    def __init__(self, path):
+        """Refer to a snapshot file, which need not exist yet."""
+        self.path = path
+
+    @staticmethod
+    def hash_file(path, size=None):
+        """Compute a hash of a file's contents, or of its first size bytes."""
+        digest = hashlib.sha1()
+        with open(path, 'rb') as in_file:
+            while size == None or size > 0:
+                block = in_file.read(1 << 20 if size == None else
+                        min(size, 1 << 20))
+                if not block:
+                    break
+                digest.update(block)
+                if size != None:
+                    size -= len(block)
+        return digest.hexdigest()
+
+    def load(self, listings_path, listings_hash):
+        """Make a list of listings from the snapshot. Return None if the
+        snapshot doesn't exist or was made from a different listings file.
+        If successful, set the parser's vocabulary to that of the snapshot
+        and make posting indexes available in self.indexes.
+        """
+        try:
+            snapshot_file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with snapshot_file:
+            # Empty files can't be mapped, such as one left by a crash.
+            if (os.fstat(snapshot_file.fileno()).st_size <
+                    len(self.magic) + 16):
+                return None
+            snapshot_map = mmap.mmap(snapshot_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        if snapshot_map[:len(self.magic)] != self.magic:
+            return None
+        header_offset, header_length = struct.unpack('<QQ',
+                snapshot_map[-16:])
+        try:
+            header = json.loads(snapshot_map[header_offset:header_offset +
+                    header_length].decode('utf-8'))
+        except ValueError:
+            # The file was cut short while it was being written.
+            return None
+        if (header['listings_hash'] != listings_hash or
+                header['byteorder'] != sys.byteorder):
+            return None
+        view = memoryview(snapshot_map)
+        sections = {}
+        for name, (offset, count, typecode) in header['sections'].items():
+            size = count * array.array(typecode).itemsize
+            sections[name] = view[offset:offset + size].cast(typecode)
+        Parser.set_vocabulary(Vocabulary(header['vocabulary']))
+        # Raw data is read from the listings file only when it's needed.
+        with open(listings_path, 'rb') as listings_file:
+            self.listings_map = mmap.mmap(listings_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        self.line_offsets = sections['line_offsets']
+        ids = header['ids']
+        listings = []
+        for position in range(header['count']):
+            tokens = TokenFields()
+            for field in self.fields:
+                a, b = sections[field + '_offsets'][position:position + 2]
+                setattr(tokens, field, TokenList(
+                        sections[field + '_ids'][a:b],
+                        sections[field + '_starts'][a:b]))
+            listing_id = position + 1 if ids == None else ids[position]
+            listings.append(SnapshotListing(self, position, listing_id,
+                    tokens))
+        self.indexes = {}
+        for field in self.fields:
+            self.indexes[field] = PostingIndex(listings,
+                    sections[field + '_posting_tokens'],
+                    sections[field + '_posting_offsets'],
+                    sections[field + '_postings'])
+        return listings
+
+    def read_data(self, position):
+        """Decode the raw data of the listing at a given position."""
+        a, b = self.line_offsets[position:position + 2]
+        data = json.loads(self.listings_map[a:b].decode('utf-8'))
+        data.pop('id', None)
+        return data
+
+    def write(self, listings_path, listings_hash, listings):
+        """Write a snapshot of listings that were loaded from a file."""
+        sections = {}
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as out_file:
+            out_file.write(self.magic)
+            def write_section(name, values):
+                # Align the array to eight bytes.
+                out_file.write(b'\0' * (-out_file.tell() % 8))
+                sections[name] = [out_file.tell(), len(values),
+                        values.typecode]
+                values.tofile(out_file)
+            # Find the offset of each line, so that raw data can be read later.
+            line_offsets = array.array('q', [0])
+            with open(listings_path, 'rb') as listings_file:
+                for line in listings_file:
+                    if len(line_offsets) > len(listings):
+                        break
+                    line_offsets.append(line_offsets[-1] + len(line))
+            write_section('line_offsets', line_offsets)
+            for field in self.fields:
+                ids, starts = array.array('i'), array.array('i')
+                offsets = array.array('q', [0])
+                postings = {}
+                for position, listing in enumerate(listings):
+                    tokens = getattr(listing.tokens, field)
+                    ids.extend(tokens.ids)
+                    starts.extend(tokens.starts)
+                    offsets.append(len(ids))
+                    for token_id in set(tokens.ids):
+                        postings.setdefault(token_id, array.array('i')).append(
+                                position)
+                write_section(field + '_ids', ids)
+                write_section(field + '_starts', starts)
+                write_section(field + '_offsets', offsets)
+                del ids, starts, offsets
+                # Posting lists are sorted by token ID, so that they can be
+                #  found with a binary search.
+                posting_tokens = array.array('i', sorted(postings))
+                posting_offsets = array.array('q', [0])
+                for token_id in posting_tokens:
+                    posting_offsets.append(posting_offsets[-1] +
+                            len(postings[token_id]))
+                write_section(field + '_posting_tokens', posting_tokens)
+                write_section(field + '_posting_offsets', posting_offsets)
+                out_file.write(b'\0' * (-out_file.tell() % 8))
+                sections[field + '_postings'] = [out_file.tell(),
+                        posting_offsets[-1], 'i']
+                for token_id in posting_tokens:
+                    postings[token_id].tofile(out_file)
+            # Line numbers are the default IDs, so we only save other IDs.
+            ids = [listing.id for listing in listings]
+            if ids == list(range(1, len(ids) + 1)):
+                ids = None
+            header = json.dumps({'listings_hash': listings_hash,
+                    'byteorder': sys.byteorder, 'count': len(listings),
+                    'ids': ids, 'vocabulary': Parser.vocabulary.strings,
+                    'sections': sections}).encode('utf-8')
+            header_offset = out_file.tell()
+            out_file.write(header)
+            out_file.write(struct.pack('<QQ', header_offset, len(header)))
+        os.replace(temporary_path, self.path)
+
+
+class MatchState:
+    """The state of an incremental run, saved in a directory so that a later
+    run can rematch only what has changed. The state consists of a snapshot
+    of the listings, the deduplicated products, each listing's candidates,
+    the rule set, the candidate limit, the fuzzy budget, and hashes of the
+    listings file and the results file.
+    """
+
+    version = 4
+
+    def __init__(self, directory):
+        """Refer to a state directory, which need not exist yet."""
+        self.directory = directory
+        self.path = os.path.join(directory, 'state.pickle')
+        self.snapshot = Snapshot(os.path.join(directory, 'listings.snapshot'))
+
+    def load(self):
+        """Return a dictionary of saved values, or None if there are none."""
+        try:
+            with open(self.path, 'rb') as in_file:
+                saved = pickle.load(in_file)
+        except FileNotFoundError:
+            return None
+        if saved.get('version') != self.version:
+            return None
+        return saved
+
+    def save(self, products, listings, listings_path, listings_size,
+            listings_hash, results_path, rules, candidate_limit,
+            fuzzy_budget):
+        """Save the state of matched listings and rewrite the snapshot."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.snapshot.write(listings_path, listings_hash, listings)
+        positions = dict((id(product), position)
+                for position, product in enumerate(products))
+        candidate_offsets = array.array('q', [0])
+        candidates, best = array.array('i'), array.array('i')
+        for listing in listings:
+            candidates.extend(positions[id(product)]
+                    for product in listing.candidates)
+            candidate_offsets.append(len(candidates))
+            product = listing.best_candidate
+            best.append(-1 if product == None else positions[id(product)])
+        saved = {'version': self.version,
+                'products': [self.product_record(product)
+                        for product in products],
+                'listings_size': listings_size, 'listings_hash': listings_hash,
+                'count': len(listings), 'candidate_offsets': candidate_offsets,
+                'candidates': candidates, 'best': best,
+                'results_path': os.path.abspath(results_path),
+                'results_hash': Snapshot.hash_file(results_path),
+                'candidate_limit': candidate_limit,
+                'rules': rules, 'fuzzy_budget': fuzzy_budget}
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as out_file:
+            pickle.dump(saved, out_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path)
+
+    @staticmethod
+    def product_record(product):
+        """Recover a product's raw data, including its ID."""
+        record = product.data.copy()
+        record['id'] = product.id
+        return record
+
+    @staticmethod
+    def product_key(record):
+        """Make a string that identifies a product's data, apart from its ID.
+        A product whose data is edited is deemed to be removed and re-added.
+        """
+        record = record.copy()
+        record.pop('id', None)
+        return json.dumps(record, sort_keys=True)
+
+
+class ListingFeed:
+    """Follows a listings file that is being appended to. Complete lines are
+    read in batches, and a JSON line for each matched listing is appended
+    to a log. After each batch, the read offset and the size of the log
+    are saved in a checkpoint file, so that a restart resumes where the
+    last batch ended without matching any listing twice.
+    """
+
+    version = 1
+
+    def __init__(self, listings_path, log_path):
+        """Refer to the files and resume from the checkpoint, if any."""
+        self.listings_path, self.log_path = listings_path, log_path
+        self.checkpoint_path = log_path + '.checkpoint'
+        self.offset = self.line_index = self.log_size = 0
+        self.restore()
+
+    def restore(self):
+        """Load the checkpoint and truncate the log to its size then. If the
+        listings file is not the one that was followed, start over.
+        """
+        try:
+            with open(self.checkpoint_path) as in_file:
+                saved = json.load(in_file)
+        except FileNotFoundError:
+            saved = None
+        if saved != None and (saved.get('version') != self.version or
+                saved['listings_path'] != os.path.abspath(self.listings_path)
+                or not self.is_line_start(saved['offset'])):
+            print('listings file was replaced, starting over')
+            saved = None
+        if saved != None:
+            self.offset, self.line_index = saved['offset'], saved['line_index']
+            self.log_size = saved['log_size']
+        # Matches logged after the checkpoint will be logged again.
+        with open(self.log_path, 'ab') as log_file:
+            log_file.truncate(self.log_size)
+
+    def is_line_start(self, offset):
+        """Check whether a line of the listings file starts at an offset."""
+        with open(self.listings_path, 'rb') as in_file:
+            if offset == 0:
+                return True
+            in_file.seek(offset - 1)
+            return in_file.read(1) == b'\n'
+
+    def read_batch(self, size):
+        """Make Listing objects from at most size complete lines after the
+        offset. A last line without a newline is still being written.
+        """
+        listings = []
+        with open(self.listings_path, 'rb') as in_file:
+            in_file.seek(self.offset)
+            for line in in_file:
+                if not line.endswith(b'\n'):
+                    break
+                data = json.loads(line.decode('utf-8'))
+                # Use the line number as the ID by default, as Main does.
+                if 'id' not in data:
+                    data['id'] = self.line_index + 1
+                listings.append(Listing(data))
+                self.offset += len(line)
+                self.line_index += 1
+                if len(listings) == size:
+                    break
+        return listings
+
+    def append(self, listings):
+        """Log the matched listings of a batch and save a checkpoint."""
+        with open(self.log_path, 'ab') as log_file:
+            for listing in listings:
+                product = listing.best_candidate
+                if product == None:
+                    continue
+                log_file.write((json.dumps({'product_name':
+                        product.product_name, 'listing': listing.result_data},
+                        ensure_ascii=False) + '\n').encode('utf-8'))
+            log_file.flush()
+            os.fsync(log_file.fileno())
+            self.log_size = log_file.tell()
+        saved = {'version': self.version,
+                'listings_path': os.path.abspath(self.listings_path),
+                'offset': self.offset, 'line_index': self.line_index,
+                'log_size': self.log_size}
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as out_file:
+            json.dump(saved, out_file)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def lag(self):
+        """Get the number of bytes of the listings file not yet read."""
+        return max(0, os.path.getsize(self.listings_path) - self.offset)
+
+
+class PostingIndex:
+    """Maps token IDs to sorted arrays of listing positions, like the
+    dictionaries made by Matcher.index_all_listings(), but is backed by the
+    posting lists of a snapshot.
+    """
+
+    def __init__(self, listings, tokens, offsets, postings):
+        """Use a sorted sequence of token IDs and, for each token, a range
+        of offsets into a sequence of listing positions.
+        """
+        self.listings = listings
+        self.tokens, self.offsets, self.postings = tokens, offsets, postings
+
+    def find(self, token_id):
+        """Return the position of a token ID in the sorted IDs, or -1."""
+        i = bisect.bisect_left(self.tokens, token_id)
+        if i < len(self.tokens) and self.tokens[i] == token_id:
+            return i
+        return -1
+
+    def __contains__(self, token_id):
+        return self.find(token_id) != -1
+
+    def __getitem__(self, token_id):
+        positions = self.get(token_id)
+        if positions == None:
+            raise KeyError(token_id)
+        return positions
+
+    def get(self, token_id, default=None):
+        """Get the sorted positions of the listings that contain a token."""
+        i = self.find(token_id)
+        if i == -1:
+            return default
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def positions(self, token_id):
+        """Get the positions for a token, which may be in no listing."""
+        return self.get(token_id, ())
+
+
+class Metrics:
+    """Gathers counts from the hot paths of matching, along with the time
+    and peak memory of each phase, and writes them as JSON or in the
+    Prometheus text format. Counts are taken by wrapping the methods of an
+    instrumented matcher, so a matcher without metrics runs as before.
+    """
+
+    top_count = 20  # The number of products listed by number of checks.
+    # Methods of the matcher that are timed as phases of their own.
+    timed_methods = ['remove_duplicate_products', 'compile_products',
+            'group_listings', 'compile_automaton', 'index_all_listings',
+            'match_all_products', 'match_by_automaton', 'match_by_vector',
+            'match_fuzzy', 'match_in_parallel', 'disambiguate_matches']
+
+    def __init__(self):
+        """Start with no counts."""
+        self.phases = collections.OrderedDict()
+        # For may_match() and may_match_found(), map each product to the
+        #  number of calls and the number of matches.
+        self.product_counts = {'may_match': {}, 'may_match_found': {}}
+        self.posting_set_sizes = Histogram()
+        self.scan_lengths = {'find': Histogram(), 'find_all': Histogram()}
+        self.sort_depth = 0
+        self.sorts = self.sort_comparisons = self.tie_checks = 0
+        self.wrapped_methods = []
+        self.original_functions = {}
+
+    @staticmethod
+    def peak_memory():
+        """Get the peak resident memory of this process in bytes, or None
+        if it can't be measured.
+        """
+        if resource == None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes and macOS reports bytes.
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def add_phase(self, name, seconds):
+        """Add the time taken by a phase, which may occur more than once."""
+        phase = self.phases.get(name)
+        if phase == None:
+            phase = self.phases[name] = {'seconds': 0.0, 'runs': 0}
+        phase['seconds'] += seconds
+        phase['runs'] += 1
+        phase['peak_memory_bytes'] = self.peak_memory()
+
+    def instrument(self, matcher):
+        """Wrap the methods of a matcher, and the token search functions
+        of all matchers, to gather counts.
+        """
+        def wrap(name, wrapper):
+            setattr(matcher, name, wrapper)
+            self.wrapped_methods.append(name)
+        def time_method(name, method):
+            def timed(*args):
+                start_time = time.time()
+                result = method(*args)
+                self.add_phase(name, time.time() - start_time)
+                return result
+            return timed
+        for name in self.timed_methods:
+            wrap(name, time_method(name, getattr(matcher, name)))
+        def count_checks(name, method):
+            counts = self.product_counts[name]
+            def counted(listing, product, *args):
+                result = method(listing, product, *args)
+                entry = counts.get(product)
+                if entry == None:
+                    entry = counts[product] = [0, 0]
+                entry[0] += 1
+                if result:
+                    entry[1] += 1
+                return result
+            return counted
+        for name in self.product_counts:
+            wrap(name, count_checks(name, getattr(matcher, name)))
+        # The index engine calls may_match() once for each listing in the
+        #  posting set that match_product() chooses.
+        match_product = matcher.match_product
+        may_match_counts = self.product_counts['may_match']
+        def match_product_counted(product):
+            before = may_match_counts.get(product, [0])[0]
+            match_product(product)
+            self.posting_set_sizes.add(
+                    may_match_counts.get(product, [0])[0] - before)
+        wrap('match_product', match_product_counted)
+        # Comparisons made while sorting are told apart from the comparison
+        #  that disambiguate() makes afterward to detect a tie.
+        detail_sort, compare_details = (matcher.detail_sort,
+                matcher.compare_details)
+        def detail_sort_counted(listing, products, start=0, length=None):
+            if self.sort_depth == 0:
+                self.sorts += 1
+            self.sort_depth += 1
+            try:
+                detail_sort(listing, products, start, length)
+            finally:
+                self.sort_depth -= 1
+        def compare_details_counted(listing, a, b):
+            if self.sort_depth:
+                self.sort_comparisons += 1
+            else:
+                self.tie_checks += 1
+            return compare_details(listing, a, b)
+        wrap('detail_sort', detail_sort_counted)
+        wrap('compare_details', compare_details_counted)
+        # The search functions are static and called through the Matcher
+        #  class, so they are replaced there until restore() is called.
+        if not self.original_functions:
+            find, find_all = Matcher.find, Matcher.find_all
+            find_lengths = self.scan_lengths['find']
+            find_all_lengths = self.scan_lengths['find_all']
+            def find_counted(tokens, sublist):
+                start = find(tokens, sublist)
+                if start == -1:
+                    find_lengths.add(max(0,
+                            len(tokens.ids) - len(sublist.ids) + 1))
+                else:
+                    find_lengths.add(start + 1)
+                return start
+            def find_all_counted(tokens, sublist):
+                find_all_lengths.add(max(0,
+                        len(tokens.ids) - len(sublist.ids) + 1))
+                return find_all(tokens, sublist)
+            self.original_functions = {'find': Matcher.__dict__['find'],
+                    'find_all': Matcher.__dict__['find_all']}
+            Matcher.find = staticmethod(find_counted)
+            Matcher.find_all = staticmethod(find_all_counted)
+
+    def restore(self):
+        """Put back the search functions replaced by instrument()."""
+        for name, function in self.original_functions.items():
+            setattr(Matcher, name, function)
+        self.original_functions = {}
+
+    def report(self):
+        """Make a dictionary of all metrics."""
+        report = collections.OrderedDict()
+        report['phases'] = [dict(phase, name=name)
+                for name, phase in self.phases.items()]
+        for name, counts in sorted(self.product_counts.items()):
+            entries = sorted(counts.items(), key=lambda item: -item[1][0])
+            report[name] = {
+                'calls': sum(entry[0] for product, entry in entries),
+                'matches': sum(entry[1] for product, entry in entries),
+                'products': len(entries),
+                'top_products': [{'product_name': product.product_name,
+                        'model': product.model, 'calls': calls,
+                        'matches': matches} for product, (calls, matches)
+                        in entries[:self.top_count]]}
+        report['posting_set_sizes'] = self.posting_set_sizes.report()
+        report['scan_lengths'] = dict((name, histogram.report())
+                for name, histogram in sorted(self.scan_lengths.items()))
+        report['detail_sort'] = {'sorts': self.sorts,
+                'comparisons': self.sort_comparisons,
+                'tie_checks': self.tie_checks}
+        return report
+
+    def write(self, path):
+        """Write the metrics to a file in the Prometheus text format if the
+        path ends in .prom, or as JSON otherwise.
+        """
+        report = self.report()
+        with open(path, 'w') as out_file:
+            if path.endswith('.prom'):
+                out_file.write(self.format_prometheus(report))
+            else:
+                out_file.write(json.dumps(report, indent=2) + '\n')
+
+    @staticmethod
+    def format_prometheus(report):
+        """Format a report in the Prometheus text exposition format."""
+        lines = []
+        def declare(name, kind, description):
+            lines.append('# HELP matcher_%s %s' % (name, description))
+            lines.append('# TYPE matcher_%s %s' % (name, kind))
+        def sample(name, value, **labels):
+            label_text = ','.join('%s="%s"' % (key, str(label).replace(
+                    '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for key, label in sorted(labels.items()))
+            if label_text:
+                name = '%s{%s}' % (name, label_text)
+            lines.append('matcher_%s %s' % (name, value))
+        declare('phase_seconds', 'gauge', 'Total time spent in a phase.')
+        for phase in report['phases']:
+            sample('phase_seconds', phase['seconds'], phase=phase['name'])
+        declare('phase_runs', 'gauge', 'Number of times a phase was run.')
+        for phase in report['phases']:
+            sample('phase_runs', phase['runs'], phase=phase['name'])
+        declare('phase_peak_memory_bytes', 'gauge',
+                'Peak resident memory of the process at the end of a phase.')
+        for phase in report['phases']:
+            if phase['peak_memory_bytes'] != None:
+                sample('phase_peak_memory_bytes', phase['peak_memory_bytes'],
+                        phase=phase['name'])
+        for kind, description in [('calls', 'Number of calls'),
+                ('matches', 'Number of calls that found a match')]:
+            declare('%s_total' % kind, 'counter',
+                    '%s to a match check.' % description)
+            for method in ['may_match', 'may_match_found']:
+                sample('%s_total' % kind, report[method][kind], method=method)
+        declare('product_calls', 'gauge',
+                'Number of match checks of the most often checked products.')
+        for method in ['may_match', 'may_match_found']:
+            for product in report[method]['top_products']:
+                sample('product_calls', product['calls'], method=method,
+                        product=product['product_name'])
+        histograms = [('posting_set_size', 'Size of the posting set chosen '
+                'for a product.', report['posting_set_sizes'], {})]
+        for function, histogram in sorted(report['scan_lengths'].items()):
+            histograms.append(('scan_length', 'Number of start positions '
+                    'tried in a token search.', histogram,
+                    {'function': function}))
+        declared = set()
+        for name, description, histogram, labels in histograms:
+            if name not in declared:
+                declare(name, 'histogram', description)
+                declared.add(name)
+            total = 0
+            for bound, count in histogram['buckets']:
+                total += count
+                sample(name + '_bucket', total, le=bound, **labels)
+            sample(name + '_bucket', histogram['count'], le='+Inf', **labels)
+            sample(name + '_sum', histogram['sum'], **labels)
+            sample(name + '_count', histogram['count'], **labels)
+        for name, description in [
+                ('sorts', 'Number of candidate sorts.'),
+                ('comparisons', 'Number of comparisons made while sorting.'),
+                ('tie_checks', 'Number of comparisons made to detect a tie.')]:
+            declare('detail_sort_%s_total' % name, 'counter', description)
+            sample('detail_sort_%s_total' % name, report['detail_sort'][name])
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram:
+    """Counts values in buckets whose upper bounds are powers of two."""
+
+    def __init__(self):
+        """Start with no values."""
+        self.buckets = {}
+        self.count = self.sum = self.maximum = 0
+
+    def add(self, value):
+        """Count a non-negative integer."""
+        bound = 0 if value == 0 else 1 << (value - 1).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def report(self):
+        """Make a dictionary with a list of (upper bound, count) pairs."""
+        return {'count': self.count, 'sum': self.sum, 'max': self.maximum,
+                'buckets': sorted(self.buckets.items())}
+
+
+class StratifiedSample:
+    """A random sample of the lines of a listings file, stratified by the
+    first token of the manufacturer and by the length of the line, which
+    is mostly made up of the title. Statistics of all the listings can be
+    estimated from it.
+    """
+
+    # Line lengths in bytes that divide strata. A line is about 75 bytes
+    #  longer than its title.
+    line_bounds = [120, 160, 200, 240]
+    stratum_minimum = 2  # The fewest listings sampled from a stratum.
+    z = 1.96  # The normal quantile for 95% confidence intervals.
+    # Finds the start of a manufacturer value without decoding the line. A
+    #  quotation mark inside a string is escaped, so the key can't be faked.
+    manufacturer_regex = re.compile(b'"manufacturer"\\s*:\\s*"([^"\\\\]*)')
+
+    def __init__(self, listing_file, size, seed=None):
+        """Choose about size lines of a ListingFile. Each stratum is sampled
+        in proportion to its size, but manufacturers that would get fewer
+        than stratum_minimum lines share strata. Only the raw bytes of the
+        lines are looked at, so none of them have to be decoded.
+        """
+        line_offsets = listing_file.line_offsets
+        self.population = len(listing_file)
+        # The first token of the first manufacturer value on each line. A
+        #  value that starts with an escape sequence has no token here.
+        manufacturers = [None] * self.population
+        tokens = {}  # Maps each raw value to its first token.
+        position = 0
+        for match in self.manufacturer_regex.finditer(listing_file.map):
+            position = bisect.bisect(line_offsets, match.start(),
+                    position) - 1
+            if manufacturers[position] != None:
+                continue
+            value = match.group(1)
+            token = tokens.get(value)
+            if token == None:
+                token_match = Parser.token_regex.search(
+                        value.decode('utf-8', 'replace').lower())
+                token = tokens[value] = (token_match.group() if token_match
+                        else '')
+            manufacturers[position] = token
+        keys = []
+        manufacturer_counts = {}
+        for position, manufacturer in enumerate(manufacturers):
+            manufacturer = manufacturer or ''
+            manufacturer_counts[manufacturer] = manufacturer_counts.get(
+                    manufacturer, 0) + 1
+            keys.append((manufacturer, bisect.bisect(self.line_bounds,
+                    line_offsets[position + 1] - line_offsets[position])))
+        fraction = min(1.0, size / max(self.population, 1))
+        strata = {}
+        for position, (manufacturer, length_class) in enumerate(keys):
+            if (manufacturer_counts[manufacturer] * fraction <
+                    self.stratum_minimum):
+                manufacturer = None
+            strata.setdefault((manufacturer, length_class),
+                    []).append(position)
+        # Each stratum is a pair of its population and its sampled lines.
+        chooser = random.Random(seed)
+        self.strata = []
+        for key in sorted(strata, key=repr):
+            positions = strata[key]
+            count = min(len(positions), max(self.stratum_minimum,
+                    int(round(len(positions) * fraction))))
+            self.strata.append((len(positions),
+                    sorted(chooser.sample(positions, count))))
+        self.positions = sorted(position for population, positions in
+                self.strata for position in positions)
+
+    def estimate(self, values):
+        """Estimate the number of listings for which a condition holds, given
+        a dictionary of 0 or 1 for each sampled position. Return the estimate
+        and the bounds of its confidence interval.
+        """
+        total = variance = 0.0
+        for population, positions in self.strata:
+            n = len(positions)
+            proportion = sum(values[position] for position in positions) / n
+            total += population * proportion
+            # Sampling without replacement, so the finite population
+            #  correction applies. A stratum sampled in full has no error.
+            if n > 1:
+                variance += (population ** 2 * (1 - n / population) *
+                        proportion * (1 - proportion) / (n - 1))
+        size = len(self.positions)
+        if size == self.population:
+            return total, total, total
+        # A Wilson score interval for the proportion, with the sample size
+        #  that gives its variance to a simple random sample. Unlike the
+        #  normal interval, it stays within [0, 1] and isn't empty when the
+        #  condition holds for none or all of the sample.
+        proportion = total / self.population
+        if variance > 0:
+            size = proportion * (1 - proportion) * self.population ** 2 / (
+                    variance)
+        else:
+            size /= 1 - size / self.population
+        z2 = self.z ** 2
+        center = (proportion + z2 / (2 * size)) / (1 + z2 / size)
+        half_width = self.z * (proportion * (1 - proportion) / size +
+                z2 / (4 * size ** 2)) ** 0.5 / (1 + z2 / size)
+        return (total, max(0.0, center - half_width) * self.population,
+                min(1.0, center + half_width) * self.population)
+
+
+class MatchService:
+    """Matches listings on request, keeping the deduplicated products and
+    their automaton in memory. If the products file changes, the products
+    are reloaded and a new matcher replaces the old one. Requests that are
+    in progress continue to use the old matcher.
+    """
+
+    def __init__(self, products_path, matcher_class=None, **options):
+        """Load the products and build a matcher for them, with the given
+        matcher options apart from the engine.
+        """
+        self.products_path = products_path
+        self.matcher_class = matcher_class or TightMatcher
+        self.options = options
+        self.lock = threading.Lock()
+        self.products_stamp = None
+        self.listing_count = 0
+        self.reload()
+
+    def products_changed(self):
+        """Check whether the products file was modified since loading."""
+        return self.file_stamp() != self.products_stamp
+
+    def file_stamp(self):
+        """Get the modification time and size of the products file."""
+        status = os.stat(self.products_path)
+        return (status.st_mtime, status.st_size)
+
+    def reload(self):
+        """Load the products and build a new matcher, unless another thread
+        has just done so.
+        """
+        with self.lock:
+            stamp = self.file_stamp()
+            if stamp == self.products_stamp:
+                return
+            products = Main.load(Product, self.products_path)
+            self.matcher = self.matcher_class(products, [],
+                    engine='automaton', **self.options)
+            self.products_stamp = stamp
+
+    def match(self, lines, show_candidates=False):
+        """Match listings given as JSON lines. Return a JSON line for each,
+        naming its best candidate and optionally all of its candidates.
+        A listing's ID, if present, is included in the result.
+        """
+        if self.products_changed():
+            self.reload()
+        matcher = self.matcher
+        results = []
+        for line in lines:
+            if line.strip() == '':
+                continue
+            data = json.loads(line)
+            if not isinstance(data, dict) or not all(isinstance(
+                    data.get(field), str) for field in Snapshot.fields):
+                raise ValueError('a listing needs a manufacturer and a title')
+            tokens = TokenFields()
+            for field in Snapshot.fields:
+                setattr(tokens, field, Parser.lookup_tokens(data[field]))
+            listing = Listing.from_tokens(data.pop('id', None), data, tokens)
+            matcher.match_listing_by_automaton(listing)
+            matcher.disambiguate(listing)
+            best = listing.best_candidate
+            result = {}
+            if listing.id != None:
+                result['id'] = listing.id
+            result['product_name'] = None if best == None else best.product_name
+            if show_candidates:
+                result['candidates'] = [product.product_name
+                        for product in listing.candidates]
+            results.append(json.dumps(result, ensure_ascii=False))
+        # Requests are handled in several threads at once.
+        with self.lock:
+            self.listing_count += len(results)
+        return results
+
+    def status(self):
+        """Describe the state of the service."""
+        return {'products': len(self.matcher.products),
+                'products_path': self.products_path,
+                'listings_matched': self.listing_count,
+                'manufacturers_resolved': len(
+                        self.matcher.manufacturers.cache)}
+
+    def serve(self, address):
+        """Handle requests until interrupted. The address is either HOST:PORT
+        or the path of a Unix socket.
+        """
+        if ':' in address and '/' not in address:
+            host, port = address.rsplit(':', 1)
+            server = MatchServer((host, int(port)), MatchRequestHandler)
+        else:
+            # Remove a socket left over from a previous run.
+            if (os.path.exists(address) and
+                    stat.S_ISSOCK(os.stat(address).st_mode)):
+                os.remove(address)
+            server = UnixMatchServer(address, UnixMatchRequestHandler)
+        server.service = self
+        print('serving on %s' % address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class MatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles HTTP requests for a MatchService:
+    - POST /match: match the JSON lines in the request body, one listing per
+      line, and respond with a JSON line for each. Add ?candidates=1 to list
+      all candidates.
+    - POST /reload: reload the products file, even if it seems unchanged.
+    - GET /status: get a JSON description of the service.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keep connections alive.
+    disable_nagle_algorithm = True  # Don't delay small responses.
+
+    def do_POST(self):
+        """Match listings or reload products."""
+        path, _, query = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        service = self.server.service
+        if path == '/match':
+            try:
+                lines = body.decode('utf-8').split('\n')
+                results = service.match(lines, 'candidates=1' in query)
+            except ValueError:
+                self.send_text(400, '%s\n' % sys.exc_info()[1])
+                return
+            self.send_text(200, ''.join(result + '\n' for result in results),
+                    'application/x-ndjson')
+        elif path == '/reload':
+            service.products_stamp = None
+            service.reload()
+            self.send_text(200, json.dumps(service.status()) + '\n',
+                    'application/json')
+        else:
+            self.send_text(404, 'not found\n')
+
+    def do_GET(self):
+        """Describe the service."""
+        if self.path == '/status':
+            self.send_text(200, json.dumps(self.server.service.status()) +
+                    '\n', 'application/json')
+        else:
+            self.send_text(404, 'not found\n')
+
+    def send_text(self, code, text, content_type='text/plain'):
+        """Send a complete response."""
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log requests. Logging would dominate the response time."""
+        pass
+
+
+class UnixMatchRequestHandler(MatchRequestHandler):
+    """Handles requests on a Unix socket, which has no Nagle algorithm."""
+
+    disable_nagle_algorithm = False
+
+
+class MatchServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server that handles each request in a new thread."""
+
+    daemon_threads = True
+
+
+class UnixMatchServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    """An HTTP server on a Unix socket that handles each request in a new
+    thread.
+    """
+
+    daemon_threads = True
+
+
+class HTMLNode:
+    """A simple representation of an HTML element, containing just enough
+    information to print out static HTML.
+    """
+
+    one_indent = '  '  # The unit of indentation.
+
+    def __init__(self, name, attributes=None, children=None):
+        """Make a specified type of HTML element. Optionally set its
+        dictionary of attribute strings and list of child elements.
+        """
+        self.name = name
+        self.attributes = attributes or {}
+        self.children = children or []
+
+    def add(self, node):
+        """Add a given HTML node as a child of this one."""
+        self.children.append(node)
+
+    def to_text(self, depth=0, indent_to_depth=0):
+        """Recursively generate a text representation of this HTML node.
+        Indentation is done to the maximum depth specified by the optional
+        argument indent_to_depth. Upon reaching this depth, indentation ceases.
+        If indent_to_depth is omitted, there is no indentation at all.
+        """
+        parts = [self.opening_text(depth, indent_to_depth)]
+        # Children.
+        for child in self.children:
+            if type(child) == HTMLNode:
+                parts.append(child.to_text(depth + 1, indent_to_depth))
+            else:
+                if depth < indent_to_depth:
+                    parts.extend((depth + 1) * [self.one_indent])
+                parts.append(str(child))
+                if depth < indent_to_depth:
+                    parts.append('\n')
+        parts.append(self.closing_text(depth, indent_to_depth))
+        return ''.join(parts)
+
+    def opening_text(self, depth=0, indent_to_depth=0):
+        """Generate the opening tag of this node, indented as by to_text().
+        Together with closing_text(), this allows the children of a node to
+        be written out one at a time.
+        """
+        parts = []
+        if depth < indent_to_depth:
+            parts.extend(depth * [self.one_indent])
+        parts.extend(['<', self.name])
+        for key, value in self.attributes.items():
+            parts.extend([' ', key, '="', value, '"'])
+        parts.append('>')
+        if depth < indent_to_depth:
+            parts.append('\n')
+        return ''.join(parts)
+
+    def closing_text(self, depth=0, indent_to_depth=0):
+        """Generate the closing tag of this node, indented as by to_text()."""
+        parts = []
+        if depth < indent_to_depth:
+            parts.extend(depth * [self.one_indent])
+        parts.extend(['</', self.name, '>'])
+        if depth < indent_to_depth:
+            parts.append('\n')
+        return ''.join(parts)
+
+
+class Container:
+    """A bag of unspecified attributes. Convenient for grouping data."""
+
+    def __init__(self, data=None):
+        """Given a dictionary, use keys and values to initialize attributes."""
+        if data:
+            for name, value in data.items():
+                setattr(self, name, value)
+
+
+class Item:
+    """Contains the raw data of a product or listing. The data fields can be
+    read as attributes. Subclasses are slotted to keep instances small.
+    """
+
+    __slots__ = ('id', 'data', 'tokens')
+
+    def __init__(self, data):
+        """Keep a copy of the data, minus the ID, which becomes a slot."""
+        self.data = data.copy()
+        self.id = self.data.pop('id')
+
+    def __getattr__(self, name):
+        """Look up a data field that isn't a slot, such as the title."""
+        # Slots that haven't been assigned, including self.data itself when
+        #  an instance is being unpickled, also end up here.
+        if name != 'data':
+            try:
+                return self.data[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+
+class Product(Item):
+    """Contains a product's raw data and tokens for use in matching. A
+    matcher gives each of its products a rule. See ProductRule.
+    """
+
+    __slots__ = ('rule',)
+
+    def __init__(self, data):
+        """Store data and tokenize the fields used in matching."""
+        super().__init__(data)
+        Parser.tokenize_attributes(self, 'manufacturer', 'family', 'model')
 
     def __str__(self):
         """Make a concise string representation for debugging."""
         family = self.family if hasattr(self, 'family') else '-'
-        return ' '.join([self.id, self.manufacturer, family, self.model])
+        return ' '.join([str(self.id), self.manufacturer, family, self.model])
+
+
+class ProductRule:
+    """The parts of a product that the match rules check, looked up once
+    when a matcher is made. Checks read these slots instead of testing for
+    raw data fields and measuring token lists each time. A product that has
+    no family has a family of None.
+    """
 
+    __slots__ = ('manufacturer', 'model', 'family', 'model_length',
+            'family_length', 'model_text_length', 'manufacturer_group',
+            'dominates')
 
-class Listing(Container):
+    def __init__(self, product):
+        """Take the token lists of a product and measure them."""
+        tokens = product.tokens
+        self.manufacturer, self.model = tokens.manufacturer, tokens.model
+        self.family = getattr(tokens, 'family', None)
+        self.model_length = len(self.model)
+        self.family_length = 0 if self.family == None else len(self.family)
+        self.model_text_length = sum(len(token.text) for token in self.model)
+        # The matcher numbers the distinct manufacturers of its products.
+        self.manufacturer_group = None
+        # The products whose model tokens are a sublist of this product's,
+        #  if the matcher's rules call for it.
+        self.dominates = None
+
+
+class Listing(Item):
     """Contains a listing's raw data and tokens for use in matching."""
 
+    __slots__ = ('candidates', 'best_candidate')
+
     def __init__(self, data):
-        """Store attributes and tokenize those used in matching."""
+        """Store data and tokenize the fields used in matching."""
         super().__init__(data)
         Parser.tokenize_attributes(self, 'manufacturer', 'title')
-        # Save a copy of the data for printing in challenge format.
-        self.result_data = data.copy()
-        del self.result_data['id']  # The Sortable validator rejects our ID.
+
+    @property
+    def result_data(self):
+        """Get the data for printing in challenge format. It has no ID,
+        because the Sortable validator rejects our ID.
+        """
+        return self.data
+
+    @staticmethod
+    def from_tokens(listing_id, data, tokens):
+        """Make a listing from raw data that has already been tokenized."""
+        listing = Listing.__new__(Listing)
+        listing.id, listing.data, listing.tokens = listing_id, data, tokens
+        return listing
 
     def __str__(self):
         """Make a concise string representation for debugging."""
-        return ' '.join([self.id, self.manufacturer, self.title])
+        return ' '.join([str(self.id), self.manufacturer, self.title])
+
+
+class SnapshotListing(Listing):
+    """A listing whose tokens were loaded from a snapshot. Its raw data is
+    read from the listings file whenever it is needed, and is not kept.
+    """
+
+    __slots__ = ('snapshot', 'position')
+
+    def __init__(self, snapshot, position, listing_id, tokens):
+        """Use tokens from the snapshot without touching the raw data."""
+        self.snapshot, self.position = snapshot, position
+        self.id, self.tokens = listing_id, tokens
+
+    @property
+    def data(self):
+        """Read the raw data, minus the ID, from the listings file."""
+        return self.snapshot.read_data(self.position)
+
+    def __reduce__(self):
+        """Pickle as an ordinary listing. Memory maps can't be pickled."""
+        return (Listing.from_tokens, (self.id, self.data, self.tokens))
+
+
+class TokenFields:
+    """Holds the token lists of a product or listing. If a field is missing
+    from the raw data, the corresponding attribute is not set.
+    """
+
+    __slots__ = ('manufacturer', 'family', 'model', 'title')
+
+
+class TokenList:
+    """A compact list of tokens. Token IDs and start positions are stored in
+    arrays. Token objects are only made when the list is indexed or iterated.
+    """
+
+    __slots__ = ('ids', 'starts')
+
+    def __init__(self, ids, starts):
+        """Use sequences of token IDs and their start positions in the text."""
+        self.ids, self.starts = ids, starts
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return Token(self.ids[i], self.starts[i])
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield Token(self.ids[i], self.starts[i])
+
+    def __reduce__(self):
+        """Pickle the IDs and starts as arrays, even if they are views."""
+        return (TokenList, (array.array('i', self.ids),
+                array.array('i', self.starts)))
 
 
 class Token:
-    """Contains a token string and the position where it was found."""
+    """Contains a token ID and the position where the token was found."""
+
+    __slots__ = ('id', 'start')
+
+    def __init__(self, token_id, start):
+        """Store the ID, which refers to the parser's vocabulary."""
+        self.id, self.start = token_id, start
 
-    def __init__(self, text, start):
+    @property
+    def text(self):
+        """Look up the token string."""
+        return Parser.vocabulary.strings[self.id]
+
+    @property
+    def span(self):
         """Make a convenient tuple of the token's start and end indices."""
-        self.text, self.start = text, start
-        self.span = (start, start + len(text))
+        return (self.start, self.start + len(self.text))
+
+
+class Vocabulary:
+    """Maps token strings to integer IDs, so that tokens can be stored and
+    compared as integers. IDs are assigned consecutively from zero.
+    """
+
+    def __init__(self, strings=None):
+        """Start with an optional list of strings, which get IDs in order."""
+        self.ids = {}
+        self.strings = []
+        for text in strings or []:
+            self.intern(text)
+
+    def intern(self, text):
+        """Get the ID of a string, assigning a new ID if necessary."""
+        token_id = self.ids.get(text)
+        if token_id == None:
+            token_id = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return token_id
+
+    def truncate(self, size):
+        """Forget every string after the first size, freeing their IDs."""
+        for text in self.strings[size:]:
+            del self.ids[text]
+        del self.strings[size:]
+
+    def __len__(self):
+        return len(self.strings)
 
 
 class Parser:
@@ -560,13 +3200,17 @@ class Parser:
 
     letter_set = set(list(string.ascii_lowercase))
     digit_set = set(list(string.digits))
+    # A token is a maximal run of either letters or digits, as above.
+    token_regex = re.compile('[a-z]+|[0-9]+')
+    vocabulary = Vocabulary()  # Shared by all tokens, so IDs are comparable.
+    cache_size = 2**16  # The default number of cached token lists.
 
     @staticmethod
     def tokenize_attributes(item, *names):
         """Given an object and one or more attribute names, make token lists
         from the named attributes and assign them to a new .tokens attribute.
         """
-        item.tokens = Container()
+        item.tokens = TokenFields()
         for name in names:
             if hasattr(item, name):
                 tokens = Parser.text_to_tokens(getattr(item, name))
@@ -575,7 +3219,78 @@ class Parser:
     @staticmethod
     def text_to_tokens(text):
         """Parse text into an ordered list of lowercase tokens."""
-        tokens = []
+        # Retailers often repeat a title across many listings, so recently
+        #  parsed texts are cached. Token lists are never modified, so it's
+        #  safe for listings to share them.
+        return Parser.cached_scan_tokens(text)
+
+    @staticmethod
+    def set_cache_size(size):
+        """Cache the token lists of up to a given number of distinct texts.
+        A size of zero disables the cache.
+        """
+        if size == 0:
+            Parser.cached_scan_tokens = staticmethod(Parser.scan_tokens)
+        else:
+            Parser.cached_scan_tokens = staticmethod(
+                    functools.lru_cache(size)(Parser.scan_tokens))
+
+    @staticmethod
+    def set_vocabulary(vocabulary):
+        """Replace the vocabulary. Cached token lists are discarded because
+        their token IDs refer to the previous vocabulary.
+        """
+        Parser.vocabulary = vocabulary
+        Parser.clear_cache()
+
+    @staticmethod
+    def truncate_vocabulary(size):
+        """Forget the tokens added after the vocabulary reached a size, such
+        as those of a chunk of listings that has been matched. The IDs of the
+        earlier tokens stay the same. Cached token lists are discarded
+        because they may refer to forgotten tokens.
+        """
+        Parser.vocabulary.truncate(size)
+        Parser.clear_cache()
+
+    @staticmethod
+    def clear_cache():
+        """Discard the cached token lists."""
+        cache_clear = getattr(Parser.cached_scan_tokens, 'cache_clear', None)
+        if cache_clear != None:
+            cache_clear()
+
+    @staticmethod
+    def scan_tokens(text):
+        """Parse text into tokens with a regular expression."""
+        ids, starts = array.array('i'), array.array('i')
+        intern = Parser.vocabulary.intern
+        for match in Parser.token_regex.finditer(text.lower()):
+            ids.append(intern(match.group()))
+            starts.append(match.start())
+        return TokenList(ids, starts)
+
+    @staticmethod
+    def lookup_tokens(text):
+        """Parse text into tokens without adding to the vocabulary. Tokens
+        that aren't in the vocabulary get the ID -1, which is never equal
+        to the ID of a product token. This is safe to do in several threads,
+        and keeps the vocabulary from growing in a long-running process.
+        """
+        ids, starts = array.array('i'), array.array('i')
+        lookup = Parser.vocabulary.ids.get
+        for match in Parser.token_regex.finditer(text.lower()):
+            ids.append(lookup(match.group(), -1))
+            starts.append(match.start())
+        return TokenList(ids, starts)
+
+    @staticmethod
+    def walk_tokens(text):
+        """Parse text into tokens by walking through it one character at a
+        time. This is much slower than scan_tokens() but yields the same
+        tokens. It is useful for verifying the correctness of scan_tokens().
+        """
+        ids, starts = array.array('i'), array.array('i')
         text = text.lower()
         pos = 0
         while pos < len(text):
@@ -584,14 +3299,15 @@ class Parser:
             for char_set in [Parser.letter_set, Parser.digit_set]:
                 if ch in char_set:
                     pos, token = Parser.parse_token(char_set, text, pos)
-                    tokens.append(token)
+                    ids.append(token.id)
+                    starts.append(token.start)
                     made_token = True
                     break
             # Making a token causes pos to advance. If there was no token to be
             #  made, pos is unchanged, so we have to advance it now.
             if not made_token:
                 pos += 1
-        return tokens
+        return TokenList(ids, starts)
 
     @staticmethod
     def parse_token(char_set, text, pos):
@@ -605,45 +3321,529 @@ class Parser:
                 break
             chars.append(text[pos])
             pos += 1
-        token = Token(''.join(chars), start)
+        token = Token(Parser.vocabulary.intern(''.join(chars)), start)
         return pos, token
 
 
+Parser.set_cache_size(Parser.cache_size)
+
+
 class Main:
     """A programmatic front end to the processes of loading data from files,
     finding matches, and writing out the results in various formats.
     """
 
-    def __init__(self, products_path, listings_path, results_path):
-        """Load data, perform matching, and write out the results."""
+    default_options = {
+        'chunk_size': None,  # If set, stream listings in chunks of this size.
+        'spill_dir': None,  # Directory for temporary files, if streaming.
+        'engine': 'index',  # The matching engine. See Matcher.
+        'workers': 1,  # The number of processes that match listings.
+        'token_cache': Parser.cache_size,  # The size of the token cache.
+        'snapshot': None,  # The path of a snapshot to use or write.
+        'state': None,  # A directory for the state of incremental runs.
+        'metrics': None,  # The path of a file of metrics to write.
+        'spill_limit': None,  # Sort results on disk beyond this many.
+        'page_size': None,  # If set, page the viewer by this many listings.
+        'candidate_limit': Matcher.candidate_limit,  # See Matcher.
+        'shard': None,  # A pair (i, n) to match only shard i of n, from 0.
+        'watch': None,  # If set, follow the listings and log matches here.
+        'interval': 1.0,  # Seconds to wait for listings when watching.
+        'rules': ['tight'],  # Names of rule sets in rule_sets, loosest first.
+        'fuzzy_budget': None,  # See Matcher.
+        'sample': None,  # If set, estimate statistics from this many listings.
+        'seed': None,  # The random seed of the sample.
+    }
+
+    # The rule sets that listings can be matched with. Each accepts a subset
+    #  of the candidates that the one before it accepts.
+    rule_sets = collections.OrderedDict([('loose', LooseMatcher),
+            ('tight', TightMatcher)])
+
+    def __init__(self, products_path, listings_path, results_path,
+            options=None):
+        """Load data, perform matching, and write out the results. Options
+        that are not specified in a dictionary take default values.
+        """
+        self.options = Container(Main.default_options)
+        if options:
+            for name, value in options.items():
+                setattr(self.options, name, value)
+        self.candidate_counts = self.rule_counts = self.estimates = None
+        self.metrics = Metrics() if self.options.metrics else None
+        Parser.set_cache_size(self.options.token_cache)
+        if self.options.watch:
+            self.watch(products_path, listings_path, self.options.watch)
+            return
+        if self.options.sample:
+            self.estimate(products_path, listings_path)
+            return
+        if self.options.chunk_size:
+            self.stream(products_path, listings_path, results_path)
+            return
+        if self.options.state:
+            self.update(products_path, listings_path, results_path)
+            return
         self.load_data(products_path, listings_path)
         self.make_matcher()
-        self.write_results(results_path)
+        if len(self.options.rules) > 1:
+            self.refine_matches(results_path)
+        else:
+            self.write_results(results_path)
+        if self.snapshot != None and self.snapshot_listings == None:
+            self.write_snapshot(listings_path)
+
+    def stream(self, products_path, listings_path, results_path):
+        """Match listings in chunks, spilling the results of each chunk to
+        disk, so that memory use does not grow with the number of listings.
+        """
+        print('loading products')
+        start_time = time.time()
+        self.products = self.load(Product, products_path)
+        self.finish_phase('load_products', start_time)
+        self.listings = []
+        self.snapshot_listings = None
+        self.make_matcher()
+        # Tokens that only occur in listings are forgotten after each chunk,
+        #  so the vocabulary doesn't grow with the number of listings.
+        vocabulary_size = len(Parser.vocabulary)
+        chunk_size = self.options.chunk_size
+        print('streaming listings in chunks of %d' % chunk_size)
+        start_time = time.time()
+        spill = ResultSpill(self.options.spill_dir)
+        if self.options.workers > 1:
+            self.matcher.open_pool()
+        try:
+            counts = {}
+            offset, line_index, count = 0, 0, None
+            if self.options.shard != None:
+                offset, line_index, count = ListingFile.find_shard(
+                        listings_path, *self.options.shard)
+            for chunk in self.load_chunks(Listing, listings_path,
+                    chunk_size, offset, line_index, count):
+                self.matcher.match_chunk(chunk)
+                self.matcher.count_candidates(counts)
+                spill.add(chunk)
+                Parser.truncate_vocabulary(vocabulary_size)
+            self.candidate_counts = counts
+            print('  %d listings' % sum(counts.values()))
+            self.finish_phase('stream_listings', start_time)
+            print('writing results to %s' % results_path)
+            start_time = time.time()
+            with open(results_path, 'w') as out_file:
+                spill.write(out_file)
+            self.finish_phase('write_results', start_time)
+        finally:
+            self.matcher.close_pool()
+            spill.close()
+
+    def watch(self, products_path, listings_path, log_path):
+        """Follow a listings file as it grows, until interrupted. New lines
+        are matched in batches of at most chunk_size listings, and matches
+        are appended to a log. When fewer lines are waiting, they are
+        matched after at most interval seconds.
+        """
+        print('loading products')
+        start_time = time.time()
+        self.products = self.load(Product, products_path)
+        self.finish_phase('load_products', start_time)
+        self.listings = []
+        self.snapshot_listings = None
+        self.make_matcher()
+        # Forget the tokens of each batch, as stream() does with chunks.
+        vocabulary_size = len(Parser.vocabulary)
+        feed = ListingFeed(listings_path, log_path)
+        batch_size = self.options.chunk_size or 10000
+        print('watching %s from line %d, logging matches to %s' % (
+                listings_path, feed.line_index + 1, log_path))
+        start_time = report_time = time.time()
+        counts = {}
+        # The listings and the seconds spent on them since the last report.
+        count = busy_seconds = 0
+        if self.options.workers > 1:
+            self.matcher.open_pool()
+        try:
+            while True:
+                batch_start_time = time.time()
+                listings = feed.read_batch(batch_size)
+                if listings:
+                    self.matcher.match_chunk(listings)
+                    self.matcher.count_candidates(counts)
+                    feed.append(listings)
+                    Parser.truncate_vocabulary(vocabulary_size)
+                    count += len(listings)
+                    busy_seconds += time.time() - batch_start_time
+                # Report progress every ten seconds while there is any.
+                if count and time.time() - report_time >= 10:
+                    self.report_watch(feed, count, busy_seconds)
+                    report_time, count, busy_seconds = time.time(), 0, 0
+                if len(listings) < batch_size:
+                    time.sleep(self.options.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.matcher.close_pool()
+        if count:
+            self.report_watch(feed, count, busy_seconds)
+        self.candidate_counts = counts
+        self.finish_phase('watch', start_time)
+
+    @staticmethod
+    def report_watch(feed, count, seconds):
+        """Show how many listings were matched since the last report, how
+        fast, and how far the watch is behind the end of the listings file.
+        """
+        print('  line %d: %d listings at %.0f/s, %d bytes behind' % (
+                feed.line_index, count, count / max(seconds, 1e-6),
+                feed.lag()))
+
+    def refine_matches(self, results_path):
+        """Write the results of each rule set to a file named after it. The
+        listings are matched with the loosest rule set, then the candidates
+        of each rule set are checked with the next one.
+        """
+        root, extension = os.path.splitext(results_path)
+        self.rule_counts = []
+        for i, name in enumerate(self.options.rules):
+            if i > 0:
+                print('refining matches with the %s rules' % name)
+                start_time = time.time()
+                self.matcher = self.matcher.refine(Main.rule_sets[name])
+                self.finish_phase('refine_' + name, start_time)
+            self.rule_counts.append((name, self.matcher.count_candidates()))
+            self.write_results('%s.%s%s' % (root, name, extension))
+
+    def estimate(self, products_path, listings_path):
+        """Match a stratified sample of listings with each rule set, and
+        estimate the candidate-count frequencies of all listings, as well as
+        the number of listings whose best candidate is changed by each rule
+        set after the first. No results are written.
+        """
+        print('sampling listings')
+        start_time = time.time()
+        listing_file = ListingFile(listings_path)
+        sample = StratifiedSample(listing_file, self.options.sample,
+                self.options.seed)
+        self.products = self.load(Product, products_path)
+        self.listings = [Listing(listing_file.read_data(position))
+                for position in sample.positions]
+        self.snapshot_listings = None
+        print('  %d of %d listings in %d strata' % (len(self.listings),
+                sample.population, len(sample.strata)))
+        self.finish_phase('sample', start_time)
+        self.make_matcher()
+        self.estimates = {'sample': len(self.listings),
+                'population': sample.population, 'rules': [],
+                'changes': []}
+        rule_counts = []
+        best = None
+        for i, name in enumerate(self.options.rules):
+            if i > 0:
+                print('refining matches with the %s rules' % name)
+                start_time = time.time()
+                self.matcher = self.matcher.refine(Main.rule_sets[name])
+                self.finish_phase('refine_' + name, start_time)
+            rule_counts.append((name, dict((position,
+                    Matcher.candidate_count(listing)) for position, listing in
+                    zip(sample.positions, self.listings))))
+            previous, best = best, [listing.best_candidate
+                    for listing in self.listings]
+            if previous != None:
+                self.estimates['changes'].append((self.options.rules[i - 1],
+                        name, sample.estimate(dict((position, int(a is not b))
+                        for position, a, b in zip(sample.positions, previous,
+                        best)))))
+        # Every count up to the largest one sampled is estimated for every
+        #  rule set, so that counts missing from the sample get upper bounds.
+        largest = max([0] + [count for name, counts in rule_counts
+                for count in counts.values()])
+        for name, counts in rule_counts:
+            self.estimates['rules'].append((name, dict((count,
+                    sample.estimate(dict((position, int(value == count))
+                    for position, value in counts.items())))
+                    for count in range(largest + 1))))
+
+    def print_estimates(self):
+        """Show the estimates made by estimate(), with their 95% confidence
+        intervals.
+        """
+        estimates = self.estimates
+        population = max(estimates['population'], 1)
+        print('estimated candidate-count frequencies from %d of %d '
+                'listings:' % (estimates['sample'], estimates['population']))
+        print('    ' + ''.join('%31s' % name
+                for name, counts in estimates['rules']))
+        for count in range(len(estimates['rules'][0][1])):
+            print('%3d:' % count + ''.join('%9.0f  %6.0f-%-6.0f %5.1f%%' % (
+                    counts[count] + (100.0 * counts[count][0] / population,))
+                    for name, counts in estimates['rules']))
+        for old_name, new_name, (total, low, high) in estimates['changes']:
+            print('best candidate changed from %s to %s: %.0f listings '
+                    '(%.0f-%.0f, %.1f%%)' % (old_name, new_name, total, low,
+                    high, 100.0 * total / population))
+
+    def update(self, products_path, listings_path, results_path):
+        """Bring the results of a previous run up to date. Listings appended
+        to the listings file are matched, and listings that may be affected
+        by added, removed, or edited products are rematched. Groups of results
+        for unaffected products are copied from the previous results file.
+        If there is no usable state, do a full run and save its state.
+        """
+        state = MatchState(self.options.state)
+        saved = state.load()
+        listings_size = os.path.getsize(listings_path)
+        if saved != None and (listings_size < saved['listings_size'] or
+                Snapshot.hash_file(listings_path, saved['listings_size']) !=
+                saved['listings_hash']):
+            print('listings file was changed, not appended to')
+            saved = None
+        if (saved != None and
+                saved['candidate_limit'] != self.options.candidate_limit):
+            # Any listing's best candidate may differ.
+            print('candidate limit was changed')
+            saved = None
+        if (saved != None and
+                saved['fuzzy_budget'] != self.options.fuzzy_budget):
+            print('inexact matching was changed')
+            saved = None
+        if saved != None and saved['rules'] != self.options.rules:
+            print('rule set was changed')
+            saved = None
+        old_listings = None
+        if saved != None:
+            print('loading data')
+            start_time = time.time()
+            old_listings = state.snapshot.load(listings_path,
+                    saved['listings_hash'])
+        if old_listings == None:
+            # Do a full run.
+            listings_hash = Snapshot.hash_file(listings_path)
+            self.load_data(products_path, listings_path)
+            self.make_matcher()
+            self.write_results(results_path)
+            print('saving state to %s' % state.directory)
+            start_time = time.time()
+            state.save(self.matcher.products, self.listings, listings_path,
+                    listings_size, listings_hash, results_path,
+                    self.options.rules, self.options.candidate_limit,
+                    self.options.fuzzy_budget)
+            self.finish_phase('save_state', start_time)
+            return
+        # The snapshot's vocabulary is in place, so we can tokenize products.
+        self.products = self.load(Product, products_path)
+        new_listings = list(self.generate_items(Listing, listings_path,
+                saved['listings_size'], saved['count']))
+        self.listings = old_listings + new_listings
+        self.finish_phase('load', start_time)
+        self.snapshot_listings = None
+        self.make_matcher(listings=[])
+        products = self.matcher.products
+        print('updating matches')
+        start_time = time.time()
+        # Compare the deduplicated products to those of the previous run.
+        old_records = saved['products']
+        old_keys = [MatchState.product_key(record) for record in old_records]
+        new_positions = dict((MatchState.product_key(product.data), position)
+                for position, product in enumerate(products))
+        old_key_set = set(old_keys)
+        changed_products = [product for product in products if
+                MatchState.product_key(product.data) not in old_key_set]
+        added_count = len(changed_products)
+        for key, record in zip(old_keys, old_records):
+            if key not in new_positions:
+                changed_products.append(Product(record))
+        print('  %d products added, %d removed' % (added_count,
+                len(changed_products) - added_count))
+        # A changed product can only have matched, or match now, listings
+        #  whose titles contain all of its model tokens.
+        title_index = state.snapshot.indexes['title']
+        affected = set()
+        for product in changed_products:
+            positions = None
+            for token_id in product.tokens.model.ids:
+                token_positions = set(title_index.positions(token_id))
+                positions = (token_positions if positions == None else
+                        positions & token_positions)
+            if positions == None:
+                positions = range(len(old_listings))
+            affected.update(positions)
+        old_to_new = [new_positions.get(key, -1) for key in old_keys]
+        candidate_offsets = saved['candidate_offsets']
+        candidates, best = saved['candidates'], saved['best']
+        if self.options.fuzzy_budget != None:
+            # Inexact candidates needn't have all of their model tokens in
+            #  the title. Listings are rematched if they had a candidate that
+            #  was removed, or if an added product is an inexact match.
+            fuzzy_index = FuzzyModelIndex(changed_products[:added_count])
+            for position, listing in enumerate(old_listings):
+                if position in affected:
+                    continue
+                product_positions = candidates[candidate_offsets[position]:
+                        candidate_offsets[position + 1]]
+                if any(old_to_new[product_position] == -1
+                        for product_position in product_positions):
+                    affected.add(position)
+                    continue
+                if fuzzy_index.find(fuzzy_index.texts(listing.tokens.title),
+                        self.options.fuzzy_budget):
+                    affected.add(position)
+        print('  %d new listings, %d listings rematched' % (
+                len(new_listings), len(affected)))
+        # Translate the saved candidates of unaffected listings.
+        changed_names = set()
+        for position, listing in enumerate(old_listings):
+            product_positions = candidates[candidate_offsets[position]:
+                    candidate_offsets[position + 1]]
+            best_position = best[position]
+            if position in affected:
+                if best_position != -1:
+                    changed_names.add(
+                            old_records[best_position]['product_name'])
+                continue
+            listing.candidates = [products[old_to_new[product_position]]
+                    for product_position in product_positions]
+            listing.best_candidate = (None if best_position == -1 else
+                    products[old_to_new[best_position]])
+        rematched = [old_listings[position] for position in sorted(affected)]
+        self.matcher.match_chunk(rematched + new_listings)
+        for listing in self.matcher.listings:
+            if listing.best_candidate != None:
+                changed_names.add(listing.best_candidate.product_name)
+        self.matcher.listings = self.listings
+        self.finish_phase('update_matches', start_time)
+        print('updating results in %s' % results_path)
+        start_time = time.time()
+        if (os.path.abspath(results_path) != saved['results_path'] or
+                not os.path.exists(results_path) or
+                Snapshot.hash_file(results_path) != saved['results_hash']):
+            # The previous results are unusable, so write all groups.
+            changed_names = None
+        self.update_results(results_path, changed_names)
+        self.finish_phase('update_results', start_time)
+        print('saving state to %s' % state.directory)
+        start_time = time.time()
+        state.save(products, self.listings, listings_path, listings_size,
+                Snapshot.hash_file(listings_path, listings_size),
+                results_path, self.options.rules,
+                self.options.candidate_limit, self.options.fuzzy_budget)
+        self.finish_phase('save_state', start_time)
+
+    def update_results(self, results_path, changed_names):
+        """Rewrite the groups of results for a set of product names, copying
+        the other groups from the existing results file. If the set is None,
+        write all groups.
+        """
+        new_lines = self.matcher.generate_result_lines(changed_names)
+        old_lines = []
+        if changed_names != None:
+            old_lines = self.read_result_lines(results_path, changed_names)
+        temporary_path = results_path + '.tmp'
+        with open(temporary_path, 'w') as out_file:
+            wrote_group = False
+            for name, line in heapq.merge(old_lines, new_lines):
+                out_file.write(line)
+                wrote_group = True
+            # Match the output of write_results() when there are no results.
+            if not wrote_group:
+                out_file.write('\n')
+        os.replace(temporary_path, results_path)
+
+    @staticmethod
+    def read_result_lines(results_path, skip_names):
+        """Generate (product name, line) pairs from a results file, skipping
+        the groups of the given product names.
+        """
+        with open(results_path) as in_file:
+            for line in in_file:
+                if line.strip() == '':
+                    continue
+                name = ResultSpill.parse_group_name(line)
+                if name not in skip_names:
+                    yield name, line
 
     def load_data(self, products_path, listings_path):
         """Slurp product and listing data from files."""
         print('loading data')
         start_time = time.time()
+        self.snapshot = self.snapshot_listings = self.listing_file = None
+        if self.options.snapshot:
+            # Load the snapshot first. Its vocabulary replaces the parser's,
+            #  so the products must be tokenized afterward.
+            self.snapshot = Snapshot(self.options.snapshot)
+            self.listings_hash = Snapshot.hash_file(listings_path)
+            self.snapshot_listings = self.snapshot.load(listings_path,
+                    self.listings_hash)
+            print('  %s snapshot %s' % ('using' if self.snapshot_listings
+                    != None else 'no current', self.snapshot.path))
         self.products = self.load(Product, products_path)
-        self.listings = self.load(Listing, listings_path)
-        print('  %.3f s' % (time.time() - start_time))
+        self.listings = self.snapshot_listings
+        if self.listings == None:
+            self.listing_file = ListingFile(listings_path)
+            start, end = 0, len(self.listing_file)
+            if self.options.shard != None:
+                start, end = self.listing_file.shard_lines(
+                        *self.options.shard)
+                print('  shard %d of %d: lines %d to %d' % (
+                        self.options.shard[0] + 1, self.options.shard[1],
+                        start + 1, end))
+            self.listings = self.listing_file.load(self.options.workers,
+                    start, end)
+        self.finish_phase('load', start_time)
 
-    def make_matcher(self):
-        """Instantiate a Matcher subclass to run the matching process."""
-        self.matcher = TightMatcher(self.products, self.listings)
+    def make_matcher(self, listings=None):
+        """Instantiate a Matcher subclass to run the matching process on the
+        given listings, by default all of them.
+        """
+        if listings == None:
+            listings = self.listings
+        indexes = None
+        if self.snapshot_listings != None and listings is self.listings:
+            indexes = self.snapshot.indexes
+        matcher_class = Main.rule_sets[self.options.rules[0]]
+        self.matcher = matcher_class(self.products, listings,
+                engine=self.options.engine, workers=self.options.workers,
+                candidate_limit=self.options.candidate_limit,
+                indexes=indexes, metrics=self.metrics,
+                spill_limit=self.options.spill_limit,
+                spill_dir=self.options.spill_dir,
+                fuzzy_budget=self.options.fuzzy_budget)
 
     @staticmethod
     def load(Item, file_path):
         """Make a list of Item objects from a file of JSON lines."""
-        items = []
+        return list(Main.generate_items(Item, file_path))
+
+    @staticmethod
+    def generate_items(Item, file_path, offset=0, line_index=0, count=None):
+        """Read a file of JSON lines and make Item objects one at a time.
+        Optionally start at a byte offset, which is at the given line index,
+        and stop after a number of lines.
+        """
         with open(file_path) as in_file:
-            for line_index, line in enumerate(in_file.readlines()):
+            in_file.seek(offset)
+            lines = in_file if count == None else itertools.islice(in_file,
+                    count)
+            for line_index, line in enumerate(lines, line_index):
                 data = json.loads(line)
                 # Allow for predefined IDs. Use the line number by default.
                 if 'id' not in data:
                     data['id'] = line_index + 1
-                items.append(Item(data))
-        return items
+                yield Item(data)
+
+    @staticmethod
+    def load_chunks(Item, file_path, chunk_size, offset=0, line_index=0,
+            count=None):
+        """Generate lists of at most chunk_size Item objects from a file, or
+        from a range of lines as in generate_items().
+        """
+        chunk = []
+        for item in Main.generate_items(Item, file_path, offset, line_index,
+                count):
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     def write_results(self, results_path):
         """Print JSON lines as specified by the Sortable challenge."""
@@ -651,19 +3851,31 @@ class Main:
         start_time = time.time()
         with open(results_path, 'w') as out_file:
             self.matcher.write_results(out_file)
-        print('  %.3f s' % (time.time() - start_time))
+        self.finish_phase('write_results', start_time)
 
-    def write_data_js(self, viewer_dir):
-        """Generate a JavaScript file containing the data necessary to build
-        a listing viewer in the client. This method is an alternative to
-        generating a static HTML file on the server.
+    def write_snapshot(self, listings_path):
+        """Save the tokenized listings and their posting lists."""
+        print('writing snapshot to %s' % self.snapshot.path)
+        start_time = time.time()
+        self.snapshot.write(listings_path, self.listings_hash, self.listings)
+        self.finish_phase('write_snapshot', start_time)
+
+    def write_data_js(self, viewer_dir, chunk_size=1000):
+        """Generate JavaScript files containing the data necessary to build
+        a listing viewer in the client, along with the page that loads them.
+        This method is an alternative to generating a static HTML file on
+        the server.
         """
-        js_path = os.path.join(viewer_dir, 'js/data.js')
-        print('writing data to %s' % js_path)
+        data_dir = os.path.join(viewer_dir, 'js', 'data')
+        print('writing data to %s' % data_dir)
         start_time = time.time()
-        with open(js_path, 'w') as out_file:
-            self.matcher.write_data_js(out_file)
-        print('  %.3f s' % (time.time() - start_time))
+        self.matcher.write_data_js(data_dir, chunk_size)
+        fragment_path = os.path.join(viewer_dir, 'fragments',
+                'dynamic_listings.html')
+        with open(os.path.join(viewer_dir, 'dynamic_listings.html'),
+                'w') as out_file:
+            out_file.write(open(fragment_path).read())
+        self.finish_phase('write_data_js', start_time)
 
     def write_viewer_html(self, viewer_dir):
         """Generate a static HTML file showing listings and candidates."""
@@ -675,10 +3887,78 @@ class Main:
         html_path = os.path.join(viewer_dir, 'listings.html')
         print('writing viewer to %s' % html_path)
         start_time = time.time()
-        with open(html_path, 'w') as out_file:
-            self.matcher.write_viewer_html(out_file, header, footer)
+        if self.options.page_size:
+            self.matcher.write_viewer_pages(viewer_dir, header, footer,
+                    self.options.page_size)
+        else:
+            with open(html_path, 'w') as out_file:
+                self.matcher.write_viewer_html(out_file, header, footer)
+        self.finish_phase('write_viewer_html', start_time)
+
+    def finish_phase(self, name, start_time):
+        """Show the time taken by a phase and add it to the metrics."""
+        seconds = time.time() - start_time
+        print('  %.3f s' % seconds)
+        if self.metrics != None:
+            self.metrics.add_phase(name, seconds)
+
+    def write_metrics(self):
+        """Write the metrics gathered during the run, if requested."""
+        if self.metrics == None:
+            return
+        print('writing metrics to %s' % self.options.metrics)
+        self.metrics.restore()
+        self.metrics.write(self.options.metrics)
+
+    @staticmethod
+    def show_listing(products_path, listings_path, listing_id,
+            rules=('tight',), **options):
+        """Match a single listing, found by ID without loading the others,
+        and show its candidates. The best candidate is marked with '*'. The
+        listing is matched with each of the named rule sets in turn, as in
+        refine_matches(), and with the given matcher options.
+        """
+        listing = ListingFile(listings_path).get(listing_id)
+        if listing == None:
+            print('no listing with ID %s' % json.dumps(listing_id))
+            return
+        products = Main.load(Product, products_path)
+        matcher = Main.rule_sets[rules[0]](products, [listing], **options)
+        print(json.dumps(listing.data, ensure_ascii=False))
+        for i, name in enumerate(rules):
+            if len(rules) > 1:
+                print('%s rules:' % name)
+            if i > 0:
+                matcher = matcher.refine(Main.rule_sets[name])
+            for product in listing.candidates:
+                print('%s %s' % ('*' if product is listing.best_candidate
+                        else ' ', product))
+
+    @staticmethod
+    def merge_results(partial_paths, results_path):
+        """Merge the results files of the shards of a run into one."""
+        print('merging %d results files into %s' % (len(partial_paths),
+                results_path))
+        start_time = time.time()
+        with open(results_path, 'w') as out_file:
+            ResultSpill.merge_results(partial_paths, out_file)
         print('  %.3f s' % (time.time() - start_time))
 
+    def print_candidate_counts(self):
+        """Show the candidate-count frequencies of all matched listings, side
+        by side for several rule sets.
+        """
+        if self.estimates != None:
+            self.print_estimates()
+        elif self.rule_counts != None:
+            Matcher.print_candidate_tables(self.rule_counts)
+        else:
+            self.matcher.print_candidate_counts(self.candidate_counts)
+        if self.options.fuzzy_budget != None:
+            counts = self.matcher.fuzzy_counts
+            print('inexact model matches: %d listings, %d over budget' % (
+                    counts['matched'], counts['over_budget']))
+
 
 def run_script():
     """Figure out file paths and pass them to the Main initializer."""
@@ -699,26 +3979,192 @@ def run_script():
     argparser.add_argument('-r', '--results', help='path to results (output)')
     argparser.add_argument('-w', '--webviewer', help='generate web viewer',
             action='store_true')
+    argparser.add_argument('-d', '--dynamicviewer', action='store_true',
+            help='generate data for the dynamic web viewer')
+    argparser.add_argument('--page-size', type=int, metavar='N',
+            help='split the web viewer into pages of N listings, or the '
+            'data of the dynamic viewer into chunks of N (default: 1000)')
+    argparser.add_argument('-c', '--chunk-size', type=int, metavar='N',
+            help='stream listings in chunks of N')
+    argparser.add_argument('--spill-dir', metavar='DIR',
+            help='directory for temporary files when streaming or sorting '
+            'results on disk')
+    argparser.add_argument('--spill-limit', type=int, metavar='N',
+            help='sort results on disk if more than N listings match')
+    argparser.add_argument('-e', '--engine',
+            choices=['index', 'automaton', 'vector'],
+            help='matching engine (default: index)')
+    argparser.add_argument('--workers', type=int, metavar='N',
+            help='match listings in N processes')
+    argparser.add_argument('--candidate-limit', type=int, metavar='N',
+            help='leave listings with more than N candidates unresolved '
+            '(default: %d)' % Matcher.candidate_limit)
+    argparser.add_argument('--token-cache', type=int, metavar='N',
+            help='cache the tokens of N distinct texts (default: %d)' %
+            Parser.cache_size)
+    argparser.add_argument('-s', '--snapshot', metavar='PATH',
+            help='use a snapshot of tokenized listings if it is current, '
+            'otherwise write one')
+    argparser.add_argument('--serve', metavar='ADDRESS',
+            help='match listings sent over HTTP to ADDRESS, which is '
+            'HOST:PORT or the path of a Unix socket')
+    argparser.add_argument('-i', '--incremental', dest='state', metavar='DIR',
+            help='rematch only what changed since the run that saved its '
+            'state in DIR')
+    argparser.add_argument('--metrics', metavar='PATH',
+            help='write counts and timings to PATH as JSON, or in the '
+            'Prometheus text format if PATH ends in .prom')
+    argparser.add_argument('--listing', metavar='ID',
+            help='match only the listing with this ID and show its '
+            'candidates')
+    argparser.add_argument('--shard', metavar='I/N',
+            help='match only the I-th of N shards of the listings file')
+    argparser.add_argument('--rules', metavar='NAMES',
+            help='comma-separated rule sets to match with in one pass, '
+            'writing a results file for each: %s (default: tight)' %
+            ', '.join(Main.rule_sets))
+    argparser.add_argument('--fuzzy', action='store_true',
+            help='look for inexact model matches in listings that have no '
+            'candidates')
+    argparser.add_argument('--fuzzy-budget', type=int, metavar='N',
+            help='look up at most N runs of title tokens for the inexact '
+            'matches of a listing (default: 1000)')
+    argparser.add_argument('--sample', type=int, metavar='N',
+            help='match a stratified sample of about N listings and '
+            'estimate the candidate-count frequencies of all of them')
+    argparser.add_argument('--seed', type=int,
+            help='random seed of the sample')
+    argparser.add_argument('--watch', metavar='LOG',
+            help='follow the listings file as it grows and append matches '
+            'to LOG, checkpointing the progress in LOG.checkpoint')
+    argparser.add_argument('--interval', type=float, metavar='SECONDS',
+            help='when watching, wait this long for more listings '
+            '(default: 1)')
+    argparser.add_argument('--merge', nargs='+', metavar='PARTIAL',
+            help='merge the results files of shards, given in shard order, '
+            'into the results file')
     arguments = argparser.parse_args()
     for name in file_names:
         value = getattr(arguments, name)
         if value != None:
             setattr(paths, name, value)
+    if arguments.chunk_size != None and arguments.chunk_size < 1:
+        argparser.error('chunk size must be positive')
+    if arguments.page_size != None and (arguments.page_size < 1 or
+            not (arguments.webviewer or arguments.dynamicviewer)):
+        argparser.error('page size must be positive and requires -w or -d')
+    if arguments.spill_limit != None and arguments.spill_limit < 1:
+        argparser.error('spill limit must be positive')
+    if arguments.chunk_size and (arguments.snapshot or arguments.state):
+        argparser.error('snapshots cannot be used when streaming')
+    if arguments.snapshot and arguments.state:
+        argparser.error('incremental runs keep their own snapshot')
+    if arguments.token_cache != None and arguments.token_cache < 0:
+        argparser.error('token cache size must not be negative')
+    if arguments.workers != None and arguments.workers < 1:
+        argparser.error('number of workers must be positive')
+    if arguments.candidate_limit != None and arguments.candidate_limit < 1:
+        argparser.error('candidate limit must be positive')
+    if arguments.chunk_size and (arguments.webviewer or
+            arguments.dynamicviewer):
+        argparser.error('the web viewer needs all listings in memory, so it '
+                'cannot be generated when streaming')
+    if arguments.shard != None:
+        match = re.match('^([0-9]+)/([0-9]+)$', arguments.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            argparser.error('shard must be I/N, with I from 1 to N')
+        if arguments.snapshot or arguments.state:
+            argparser.error('a shard cannot be matched with a snapshot or '
+                    'incrementally')
+        arguments.shard = (int(match.group(1)) - 1, int(match.group(2)))
+    if arguments.interval != None and (arguments.interval <= 0 or
+            not arguments.watch):
+        argparser.error('interval must be positive and requires --watch')
+    if arguments.watch and (arguments.snapshot or arguments.state or
+            arguments.shard or arguments.webviewer or
+            arguments.dynamicviewer):
+        argparser.error('watching cannot be combined with snapshots, '
+                'incremental runs, shards, or the web viewer')
+    if arguments.rules != None:
+        names = arguments.rules.split(',')
+        if not set(names) <= set(Main.rule_sets):
+            argparser.error('rule sets must be among: %s' %
+                    ', '.join(Main.rule_sets))
+        # Refinement goes from the loosest rule set to the tightest.
+        arguments.rules = [name for name in Main.rule_sets if name in names]
+        if len(arguments.rules) > 1 and (arguments.chunk_size or
+                arguments.watch):
+            argparser.error('several rule sets can only be matched with all '
+                    'listings in memory')
+        if len(arguments.rules) > 1 and arguments.state:
+            argparser.error('incremental runs use a single rule set')
+    if arguments.fuzzy_budget != None and (arguments.fuzzy_budget <= 0 or
+            not arguments.fuzzy):
+        argparser.error('fuzzy budget must be positive and requires --fuzzy')
+    if arguments.fuzzy:
+        arguments.fuzzy_budget = arguments.fuzzy_budget or 1000
+    if arguments.serve and (arguments.fuzzy or len(arguments.rules or []) > 1):
+        # Inexact matching needs the text of every listing token, but the
+        #  server leaves listing tokens out of the vocabulary.
+        argparser.error('the server matches with a single rule set and '
+                'without inexact matching')
+    if arguments.sample != None:
+        if arguments.sample < 1:
+            argparser.error('sample size must be positive')
+        if (arguments.chunk_size or arguments.snapshot or arguments.state or
+                arguments.watch or arguments.shard or arguments.webviewer or
+                arguments.dynamicviewer):
+            argparser.error('a sample is matched on its own, without '
+                    'streaming, snapshots, incremental runs, watching, '
+                    'shards, or the web viewer')
+    elif arguments.seed != None:
+        argparser.error('a seed requires --sample')
+    if arguments.engine == 'vector' and numpy == None:
+        print('NumPy is not installed, so the index engine is used')
+    options = {}
+    for name in Main.default_options:
+        value = getattr(arguments, name, None)
+        if value != None:
+            options[name] = value
     # Perform matching and optionally generate the HTML viewer.
     try:
-        main = Main(paths.products, paths.listings, paths.results)
+        if arguments.serve:
+            rules = arguments.rules or Main.default_options['rules']
+            MatchService(paths.products, Main.rule_sets[rules[0]],
+                    candidate_limit=arguments.candidate_limit or
+                    Matcher.candidate_limit).serve(arguments.serve)
+            return
+        if arguments.listing != None:
+            # IDs are line numbers unless the listings have their own.
+            try:
+                listing_id = json.loads(arguments.listing)
+            except ValueError:
+                listing_id = arguments.listing
+            Main.show_listing(paths.products, paths.listings, listing_id,
+                    arguments.rules or Main.default_options['rules'],
+                    candidate_limit=arguments.candidate_limit or
+                    Matcher.candidate_limit,
+                    fuzzy_budget=arguments.fuzzy_budget)
+            return
+        if arguments.merge:
+            Main.merge_results(arguments.merge, paths.results)
+            return
+        main = Main(paths.products, paths.listings, paths.results, options)
         if arguments.webviewer:
             main.write_viewer_html(viewer_dir)
+        if arguments.dynamicviewer:
+            main.write_data_js(viewer_dir, arguments.page_size or 1000)
+        main.write_metrics()
     except (FileNotFoundError, PermissionError):
         error = sys.exc_info()[1]
         print('%s: %s' % (type(error).__name__, error))
         return
     # Print summary statistics.
-    main.matcher.print_candidate_counts()
+    main.print_candidate_counts()
 
 def check_python_version():
     """Do what it says on the tin."""
-    major, minor = 3, 2
+    major, minor = 3, 4
     if sys.version_info[:2] < (major, minor):
         sys.exit('Python version >= %d.%d required' % (major, minor))
 
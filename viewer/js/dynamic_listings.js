@@ -1,21 +1,35 @@
 var ListingViewer = (function () {
   'use strict';
 
-  // requires: data.js
+  // requires: mikelib.js
 
-  // This module uses the product and listing data in data.js to build the
-  //   listing viewer. The page is blank while the elements are being built,
-  //   which takes several seconds if there are tens of thousands of items.
-  // I have replaced this approach with one that generates the listing viewer
-  //   in advance and writes it to static HTML.
+  // This module builds the listing viewer from the data files written by
+  //   matcher.py -d to js/data. The index file, which is loaded first,
+  //   holds the products and the size of each group of listings. The
+  //   listings of each group are split into chunk files. A chunk is loaded
+  //   and rendered when the end of its group scrolls into view, so the time
+  //   to show the first listings doesn't depend on the number of listings.
+  // Data files are loaded with script elements rather than XMLHttpRequest,
+  //   so that the viewer also works when opened from the file system.
 
-  var groupOrder = ['multipleUnresolved', 'multipleResolved', 'one', 'zero'],
+  var dataPath = 'js/data/',
+      loadMargin = 1500,  // Load more when the end is this close, in pixels.
+      groupOrder = ['unresolved', 'resolved', 'single', 'none'],
       groupInfo = {
-        multipleUnresolved: {numberText: 'Unresolved multiple', plural: 's'},
-        multipleResolved: {numberText: 'Resolved multiple', plural: 's'},
-        one: {numberText: 'Single', plural: ''},
-        zero: {numberText: 'No', plural: ''}
-      };
+        unresolved: {numberText: 'Unresolved multiple', plural: 's'},
+        resolved: {numberText: 'Resolved multiple', plural: 's'},
+        single: {numberText: 'Single', plural: ''},
+        none: {numberText: 'No', plural: ''}
+      },
+      // Products are arrays of an ID followed by text and token spans for
+      //   each field. Listings are arrays of an ID, text and token spans for
+      //   each field, the positions of the candidate products, and the
+      //   position of the best candidate or -1.
+      productFields = {manufacturer: 1, family: 3, model: 5},
+      listingFields = {manufacturer: 1, title: 3},
+      candidatesIndex = 5,
+      bestIndex = 6,
+      products;
 
   function format(x, decimalDigits) {
     var s = '' + Math.round(Math.pow(10, decimalDigits) * x),
@@ -23,44 +37,138 @@ var ListingViewer = (function () {
     return (pos == 0 ? '0' : s.substring(0, pos)) + '.' + s.substring(pos);
   }
 
-  function load() {
-    var wrapper, productMap, listingGroups,
-        menu, button, linkContainer;
-    // Index products by name.
-    productMap = Object.create(null);
-    products.forEach(function (product) {
-      productMap[product.id] = product;
-    });
-    // Group listings according to candidate count.
-    listingGroups = {};
-    groupOrder.forEach(function (key) {
-      listingGroups[key] = [];
-    });
-    listings.forEach(function (listing) {
-      var count = listing.candidateKeys.length,
-          key;
-      if (count <= 1) {
-        key = (count == 0 ? 'zero' : 'one');
+  function loadScript(name) {
+    M.make('script', {src: dataPath + name + '.js', parent: document.body});
+  }
+
+  function makePair(parent, field, key, value) {
+    var pair = M.make('div', {className: 'pair ' + field, parent: parent});
+    M.make('span', {className: 'key', parent: pair, innerHTML: key});
+    return M.make('span', {className: 'value', parent: pair,
+        innerHTML: value});
+  }
+
+  function highlight(text, spans, tokenMap, field) {
+    // Wrap tokens in span elements, working backward so that the token
+    //   spans remain valid. If a token map is given, only the tokens in it
+    //   are highlighted, with their mapped field names.
+    var i, a, b, token,
+        textLower = text.toLowerCase();
+    for (i = spans.length - 2; i >= 0; i -= 2) {
+      a = spans[i];
+      b = spans[i + 1];
+      token = textLower.substring(a, b);
+      if (field === undefined) {
+        if (!(token in tokenMap)) {
+          continue;
+        }
       } else {
-        key = 'multiple' + (typeof listing.bestCandidateKey == 'number' ?
-            'Resolved' : 'Unresolved');
+        // Save the token to be highlighted later in the listing field.
+        tokenMap[token] = field;
+      }
+      text = text.substring(0, a) + '<span class="match ' +
+          (field === undefined ? tokenMap[token] : field) + '">' +
+          text.substring(a, b) + '</span>' + text.substring(b);
+    }
+    return text;
+  }
+
+  function renderListing(listing, parent) {
+    var container = M.make('div', {className: 'listingContainer',
+            parent: parent}),
+        listingBox = M.make('div', {className: 'listing',
+            parent: container}),
+        tokenMaps = {manufacturer: Object.create(null),
+            title: Object.create(null)},
+        valueElements = {};
+    // Display the listing. The text is highlighted after the candidates.
+    makePair(listingBox, 'id', 'listing', listing[0]);
+    valueElements.manufacturer = makePair(listingBox, 'manufacturer',
+        'manufacturer', '');
+    M.make('br', {parent: listingBox});
+    valueElements.title = makePair(listingBox, 'title', 'title', '');
+    // Display the listing's match candidates.
+    listing[candidatesIndex].forEach(function (position) {
+      var product = products[position],
+          productBox = M.make('div', {className: 'product',
+              parent: container});
+      if (position == listing[bestIndex]) {
+        M.classAdd(productBox, 'selected');
       }
-      listingGroups[key].push(listing);
+      makePair(productBox, 'id', 'product', product[0]);
+      ['manufacturer', 'family', 'model'].forEach(function (field) {
+        var index = productFields[field];
+        // There may be no family.
+        if (product[index] === null) {
+          return;
+        }
+        makePair(productBox, field, field, highlight(product[index],
+            product[index + 1], tokenMaps[field == 'manufacturer' ?
+                'manufacturer' : 'title'], field));
+      });
+    });
+    // Inject highlighting into the listing text.
+    ['manufacturer', 'title'].forEach(function (field) {
+      var index = listingFields[field];
+      valueElements[field].innerHTML = highlight(listing[index],
+          listing[index + 1], tokenMaps[field]);
     });
-    wrapper = M.make('div', {id: 'wrapper', parent: document.body});
-    // Build DOM elements to display the contents of each group.
+  }
+
+  function loadVisibleChunks() {
+    // Request the next chunk of each group whose end is nearly in view.
     groupOrder.forEach(function (name) {
-      var group = listingGroups[name],
-          size = group.length,
+      var info = groupInfo[name];
+      if (info.loading || info.loadedCount == info.chunkCount) {
+        return;
+      }
+      if (info.end.getBoundingClientRect().top <
+          window.innerHeight + loadMargin) {
+        info.loading = true;
+        loadScript(name + '-' + (info.loadedCount + 1));
+      }
+    });
+  }
+
+  function addChunk(name, number, listings) {
+    // Render a chunk of listings loaded from a data file.
+    var info = groupInfo[name];
+    listings.forEach(function (listing) {
+      renderListing(listing, info.listingBox);
+    });
+    info.loadedCount = number;
+    info.loading = false;
+    if (info.loadedCount == info.chunkCount) {
+      info.end.style.display = 'none';
+    }
+    loadVisibleChunks();
+  }
+
+  function setIndex(index) {
+    // Build the groups and the menu. Listings are added chunk by chunk.
+    var wrapper = M.make('div', {id: 'wrapper', parent: document.body}),
+        menu, button, linkContainer;
+    products = index.products;
+    index.groups.forEach(function (group) {
+      var info = groupInfo[group.name],
+          size = group.count,
           groupBox = M.make('div', {className: 'group', parent: wrapper}),
-          info = groupInfo[name],
           headerText = info.headerText = info.numberText +
               ' candidate' + info.plural + ': ' + size +
               ' listing' + (size == 1 ? '' : 's') + ' (' +
-              format(100 * size / listings.length, 1) + '%)',
+              format(100 * size / Math.max(index.listingCount, 1), 1) + '%)',
           header = M.make('h2', {className: 'header', parent: groupBox,
               innerHTML: headerText});
       info.element = groupBox;
+      info.listingBox = M.make('div', {parent: groupBox});
+      info.end = M.make('div', {className: 'more', parent: groupBox,
+          innerHTML: 'loading'});
+      info.chunkCount = group.chunkCount;
+      info.loadedCount = 0;
+      info.loading = false;
+      if (group.chunkCount == 0) {
+        info.end.style.display = 'none';
+      }
       M.makeUnselectable(header);
       M.classAdd(groupBox, 'show');
       header.onclick = function () {
@@ -70,95 +178,6 @@ var ListingViewer = (function () {
           M.classAdd(groupBox, 'show');
         }
       };
-      group.forEach(function (listing) {
-        var container = M.make('div', {className: 'listingContainer',
-                parent: groupBox}),
-            listingBox = M.make('div', {className: 'listing',
-                parent: container}),
-            spans, i, a, b, text, textLower, token, tokenLower, tokenMap;
-        // Display the listing.
-        ['id', 'manufacturer', 'title'].forEach(function (field) {
-          var pair = M.make('div', {className: 'pair ' + field,
-                  parent: listingBox});
-          if (field == 'id') {
-            M.make('span', {className: 'key', parent: pair,
-                innerHTML: 'listing'});
-            M.make('span', {className: 'value', parent: pair,
-                innerHTML: listing.id});
-            return;
-          }
-          M.make('span', {className: 'key', parent: pair, innerHTML: field});
-          // Save the value element for later. The text needs highlighting.
-          listing[field].element = M.make('span', {className: 'value',
-              parent: pair});
-          listing[field].tokenMap = Object.create(null);
-          if (field == 'manufacturer') {
-            M.make('br', {parent: listingBox});
-          }
-        });
-        // Display the listing's match candidates.
-        listing.candidateKeys.forEach(function (id) {
-          var product = productMap[id],
-              productBox = M.make('div', {className: 'product',
-                  parent: container});
-          if (id == listing.bestCandidateKey) {
-            M.classAdd(productBox, 'selected');
-          }
-          ['id', 'manufacturer', 'family', 'model'].forEach(function (field) {
-            var pair;
-            if (!(field in product)) {
-              return;
-            }
-            pair = M.make('div', {className: 'pair ' + field,
-                parent: productBox});
-            if (field == 'id') {
-              M.make('span', {className: 'key', parent: pair,
-                  innerHTML: 'product'});
-              M.make('span', {className: 'value', parent: pair,
-                  innerHTML: product.id});
-              return;
-            }
-            // Inject highlighting into the product text.
-            text = product[field].text;
-            textLower = text.toLowerCase();
-            spans = product[field].tokenSpans;
-            tokenMap = listing[field == 'manufacturer' ?
-                'manufacturer' : 'title'].tokenMap;
-            for (i = spans.length - 1; i >= 0; --i) {
-              a = spans[i][0];
-              b = spans[i][1];
-              // Save the token to be highlighted later in the listing field.
-              token = textLower.substring(a, b);
-              tokenMap[token] = field;
-              text = text.substring(0, a) + '<span class="match ' + field +
-                  '">' + text.substring(a, b) + '</span>' + text.substring(b);
-            }
-            M.make('span', {className: 'key', parent: pair,
-                innerHTML: field});
-            M.make('span', {className: 'value', parent: pair,
-                innerHTML: text});
-          });
-        });
-        // Inject highlighting into the appropriate listing text.
-        ['manufacturer', 'title'].forEach(function (field) {
-          var target = listing[field];
-          text = target.text;
-          textLower = text.toLowerCase();
-          spans = target.tokenSpans;
-          tokenMap = target.tokenMap;
-          for (i = spans.length - 1; i >= 0; --i) {
-            a = spans[i][0];
-            b = spans[i][1];
-            token = textLower.substring(a, b);
-            if (token in tokenMap) {
-              text = text.substring(0, a) + '<span class="match ' + 
-                  tokenMap[token] + '">' + text.substring(a, b) +
-                  '</span>' + text.substring(b);
-            }
-          }
-          target.element.innerHTML = text;
-        });
-      });
     });
     // Build navigation menu.
     menu = M.make('div', {id: 'menu', parent: wrapper});
@@ -172,6 +191,7 @@ var ListingViewer = (function () {
       link.onclick = function () {
         groupElement.scrollIntoView();
         button.click();
+        loadVisibleChunks();
       };
     });
     button.onclick = function () {
@@ -181,12 +201,21 @@ var ListingViewer = (function () {
         M.classAdd(menu, 'show');
       }
     };
+    window.addEventListener('scroll', loadVisibleChunks);
+    window.addEventListener('resize', loadVisibleChunks);
     // Now we can get rid of the spinner.
     M.classAdd(document.getElementById('spinner'), 'done');
+    loadVisibleChunks();
+  }
+
+  function load() {
+    loadScript('index');
   }
 
   return {
-    load: load
+    load: load,
+    setIndex: setIndex,
+    addChunk: addChunk
   };
 })();
 